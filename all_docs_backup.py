@@ -6,6 +6,19 @@ import os
 import sys
 import getopt
 import getpass
+import threading
+import zlib
+import base64
+import hashlib
+import urllib
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+import backup_common
+import all_docs_repo
+import request_throttle
 
 
 # configuration values
@@ -16,14 +29,41 @@ config = dict(
     outputpath = './all_docs_output_{0}'.format(int(time.time())),
     authheader = '',
     num_threads = 20,
+    # rows per _all_docs page; 0 streams each database with a single request
+    page_size = 0,
+    # databases with more docs than this are fetched as parallel key ranges; 0 disables
+    split_threshold = 0,
+    # compression applied to the output files: none, gzip or zstd
+    codec = 'none',
+    # order of the work queue: none (as listed), size (largest first) or binpack (per worker)
+    schedule = 'none',
+    # output format: json (the _all_docs response) or ndjson (one document per line)
+    format = 'json',
+    # write a sorted _id index next to every backup file, see all_docs_lookup.py
+    index = False,
+    # process wide request and byte rates, see request_throttle.py; 0 is unlimited
+    rate_limit = 0,
+    byte_limit = 0,
+    # stream attachment bodies to content addressed files under .attachments in the output directory
+    attachments = False,
+    # back up into a deduplicating repository instead of the output directory, see all_docs_repo.py
+    repopath = '',
+    # docs listed per _all_docs?keys fetch of the revisions a repository doesn't hold yet
+    repo_batch = 500,
     )
 
-usage = 'python ' + os.path.basename(__file__) + ' -a <accountname> [-u <username>]'
+# what each worker actually got through
+worker_loads = []
+
+# the repository written to with -R, opened in main()
+repository = None
+
+usage = 'python ' + os.path.basename(__file__) + ' -a <accountname> [-u <username>] [-o <output dir>] [-g <rows per page>] [-s <docs>] [-c <none|gzip|zstd>] [-S <none|size|binpack>] [-f <json|ndjson>] [-x] [--ratelimit=<requests/sec>] [--bytelimit=<bytes/sec>] [-A] [-R <repository>]'
 
 def parse_args(argv):
     # parse through the argument list and update the config dict as appropriate
     try:
-        opts, args = getopt.getopt(argv, "hu:a:", ["help", "username=", "accountname="])
+        opts, args = getopt.getopt(argv, "hu:a:o:g:s:c:S:f:xAR:", ["help", "username=", "accountname=", "output=", "pagesize=", "split=", "compress=", "schedule=", "format=", "index", "ratelimit=", "bytelimit=", "attachments", "repo="])
     except getopt.GetoptError:
         print usage
         sys.exit(2)
@@ -35,6 +75,28 @@ def parse_args(argv):
             config['username'] = arg
         elif opt in ("-a", "--accountname"):
             config['accountname'] = arg
+        elif opt in ("-o", "--output"):
+            config['outputpath'] = arg
+        elif opt in ("-g", "--pagesize"):
+            config['page_size'] = int(arg)
+        elif opt in ("-s", "--split"):
+            config['split_threshold'] = int(arg)
+        elif opt in ("-c", "--compress"):
+            config['codec'] = arg
+        elif opt in ("-S", "--schedule"):
+            config['schedule'] = arg
+        elif opt in ("-f", "--format"):
+            config['format'] = arg
+        elif opt in ("-x", "--index"):
+            config['index'] = True
+        elif opt == "--ratelimit":
+            config['rate_limit'] = float(arg)
+        elif opt == "--bytelimit":
+            config['byte_limit'] = int(arg)
+        elif opt in ("-A", "--attachments"):
+            config['attachments'] = True
+        elif opt in ("-R", "--repo"):
+            config['repopath'] = arg
 
 
 def init_config():
@@ -43,6 +105,24 @@ def init_config():
         sys.exit()
     if config['username'] == '':
         config['username'] = config['accountname']
+    if config['codec'] not in backup_common.codec_suffixes:
+        print usage
+        sys.exit()
+    if config['schedule'] not in ['none', 'size', 'binpack']:
+        print usage
+        sys.exit()
+    if config['format'] not in ['json', 'ndjson']:
+        print usage
+        sys.exit()
+    if config['index'] and config['codec'] != 'none':
+        print 'Only uncompressed backups can be indexed.'
+        sys.exit()
+    if config['repopath'] != '' and (config['page_size'] > 0 or config['split_threshold'] > 0 or config['codec'] != 'none' or config['index']):
+        print 'The -g, -s, -c and -x options do not apply to a repository backup.'
+        sys.exit()
+    if config['codec'] == 'zstd' and zstandard is None:
+        print 'The zstandard module is required for zstd output.  Try "pip install zstandard".'
+        sys.exit()
     
     config['baseurl'] = 'https://{0}.cloudant.com/'.format(config['accountname'])
 
@@ -64,23 +144,333 @@ def authenticate():
     config['authheader'] = {'Cookie': response.headers['set-cookie']}
 
 
-def stream_all_docs(queue):
-	s = requests.Session()
+def checkpoint_path(db):
+    # hidden so that all_docs_restore.py does not mistake it for a database file
+    return '{0}/.{1}.json.checkpoint'.format(config['outputpath'], db)
+
+
+def read_page_checkpoint(db):
+    path = checkpoint_path(db)
+    if not os.path.exists(path):
+        return None
+    with open(path, 'r') as f:
+        return json.load(f)
+
+
+def write_page_checkpoint(db, checkpoint):
+    # write then rename so a crash can never leave a torn checkpoint behind
+    path = checkpoint_path(db)
+    with open(path + '.tmp', 'w') as f:
+        f.write(json.dumps(checkpoint))
+        f.flush()
+        os.fsync(f.fileno())
+    os.rename(path + '.tmp', path)
+
+
+def get_page(db, params, session, retries=5):
+    retries -= 1
+    try:
+        if retries >= 0:
+            r = session.get('{0}{1}/_all_docs'.format(config['baseurl'], db), headers=config['authheader'], params=params)
+            if r.status_code != 200:
+                print 'Failed to retrieve a page of "{0}"!  Retrying.'.format(db)
+                print json.dumps(r.json(), indent=4)
+                request_throttle.backoff()
+                return get_page(db, params, session, retries)
+            return r.json()
+        else:
+            print 'get_page:  Error! Retries exceeded.  Rerun with -o to resume "{0}".'.format(db)
+            return None
+    except:
+        print 'get_page:  Warning!  Page request failed.  Retrying.'
+        request_throttle.backoff()
+        return get_page(db, params, session, retries)
+
+
+def encode_block(data):
+    # every block is a complete gzip member or zstd frame, so the file stays
+    # readable when it is cut back to any block boundary
+    if config['codec'] == 'gzip':
+        c = zlib.compressobj(6, zlib.DEFLATED, 31)
+        return c.compress(data) + c.flush()
+    elif config['codec'] == 'zstd':
+        return zstandard.ZstdCompressor(level=3).compress(data)
+    return data
+
+
+def page_all_docs(db, session):
+    # Walk _all_docs one page at a time.  The output has the same layout as a
+    # streamed _all_docs response, and after every page the last key and the
+    # byte offset of the file are checkpointed so a rerun can pick up there.
+    filename = planner.output_filename(db)
+    checkpoint = read_page_checkpoint(db)
+
+    if checkpoint is not None and checkpoint['complete']:
+        print 'Skipping {0}, it was already saved...'.format(db)
+        return
+
+    if checkpoint is not None and os.path.exists(filename):
+        # anything past the checkpointed offset belongs to an unfinished page
+        f = open(filename, 'r+b')
+        f.truncate(checkpoint['offset'])
+        f.seek(checkpoint['offset'])
+        print 'Resuming {0} after {1} rows...'.format(db, checkpoint['rows'])
+    else:
+        checkpoint = dict(last_key=None, offset=0, rows=0, complete=False)
+        f = open(filename, 'wb')
+
+    with f:
+        while not checkpoint['complete']:
+            params = {'include_docs': 'true', 'limit': config['page_size']}
+            if checkpoint['last_key'] is not None:
+                params['startkey'] = json.dumps(checkpoint['last_key'])
+                params['skip'] = 1
+
+            page = get_page(db, params, session)
+            if page is None:
+                return
+
+            block = []
+            refs = []
+            if checkpoint['offset'] == 0 and config['format'] == 'json':
+                block.append('{{"total_rows":{0},"offset":0,"rows":['.format(page['total_rows']))
+
+            for row in page['rows']:
+                if config['format'] == 'ndjson':
+                    block.append(backup_common.format_doc(row['doc']))
+                else:
+                    if checkpoint['rows'] > 0:
+                        block.append(',')
+                    block.append('\n' + json.dumps(row))
+                if config['attachments']:
+                    refs.extend(backup_common.attachment_refs(row.get('doc')))
+                checkpoint['rows'] += 1
+
+            if len(page['rows']) > 0:
+                checkpoint['last_key'] = page['rows'][-1]['key']
+            if len(page['rows']) < config['page_size']:
+                if config['format'] == 'json':
+                    block.append('\n]}\n')
+                checkpoint['complete'] = True
+
+            f.write(encode_block(''.join(block)))
+            f.flush()
+            os.fsync(f.fileno())
+            # the page only counts as saved once its attachments are too
+            if not save_attachments(db, refs, session):
+                print 'Stopped {0} short of the end.  Rerun with -o to resume it.'.format(db)
+                return
+            checkpoint['offset'] = f.tell()
+            write_page_checkpoint(db, checkpoint)
+
+    planner.index_output(filename)
+    print 'Saved {0}...'.format(db)
+
+
+def save_attachment(db, ref, session, retries=5):
+    doc_id, rev, name, stub = ref
+    path = backup_common.attachment_path(os.path.join(config['repopath'] or config['outputpath'], '.attachments'), stub['digest'])
+    if os.path.exists(path):
+        return True
+    directory = os.path.dirname(path)
+    if not os.path.isdir(directory):
+        try:
+            os.makedirs(directory)
+        except OSError:
+            # another thread created it first
+            pass
+
+    retries -= 1
+    try:
+        if retries >= 0:
+            r = session.get('{0}{1}/{2}/{3}'.format(config['baseurl'], db, backup_common.doc_path(doc_id), urllib.quote(name.encode('utf-8'), '')),
+                            headers=config['authheader'], params={'rev': rev}, stream=True)
+            if r.status_code != 200:
+                print 'Failed to retrieve attachment "{0}" of "{1}" in {2}!  Retrying.'.format(name, doc_id, db)
+                r.close()
+                request_throttle.backoff()
+                return save_attachment(db, ref, session, retries)
+
+            # streamed through a temporary file, one block in memory at a time
+            tmp = '{0}.{1}.tmp'.format(path, threading.current_thread().ident)
+            md5 = hashlib.md5()
+            length = 0
+            with open(tmp, 'wb') as f:
+                for chunk in r.iter_content(chunk_size=65536):
+                    md5.update(chunk)
+                    length += len(chunk)
+                    f.write(chunk)
+
+            # the digest of an attachment the server keeps compressed is of the compressed bytes
+            digest_ok = 'encoding' in stub or not stub['digest'].startswith('md5-') or stub['digest'] == 'md5-' + base64.b64encode(md5.digest())
+            if length != stub.get('length', length) or not digest_ok:
+                os.remove(tmp)
+                print 'Attachment "{0}" of "{1}" in {2} does not match its stub!  Retrying.'.format(name, doc_id, db)
+                request_throttle.backoff()
+                return save_attachment(db, ref, session, retries)
+            os.rename(tmp, path)
+            return True
+        else:
+            print 'save_attachment:  Error! Retries exceeded.  Failed to save attachment "{0}" of "{1}" in {2}.'.format(name, doc_id, db)
+            return False
+    except:
+        print 'save_attachment:  Warning!  Attachment download failed.  Retrying.'
+        request_throttle.backoff()
+        return save_attachment(db, ref, session, retries)
+
+
+def save_attachments(db, refs, session):
+    ok = True
+    for ref in refs:
+        ok = save_attachment(db, ref, session) and ok
+    if len(refs) > 0:
+        print 'Saved {0} attachments of {1}...'.format(len(refs), db)
+    return ok
+
+
+# sizes, splits and saves the databases, see backup_common.BackupPlanner
+planner = backup_common.BackupPlanner(config, save_attachments=save_attachments)
+
+
+def get_docs(db, ids, session, retries=5):
+    retries -= 1
+    try:
+        if retries >= 0:
+            headers = dict(config['authheader'])
+            headers.update({'Content-type': 'application/json'})
+            r = session.post('{0}{1}/_all_docs'.format(config['baseurl'], db), headers=headers,
+                             params={'include_docs': 'true'}, data=json.dumps({'keys': ids}))
+            if r.status_code != 200:
+                print 'Failed to retrieve {0} docs of "{1}"!  Retrying.'.format(len(ids), db)
+                print json.dumps(r.json(), indent=4)
+                request_throttle.backoff()
+                return get_docs(db, ids, session, retries)
+            return [row['doc'] for row in r.json()['rows'] if row.get('doc') is not None]
+        else:
+            print 'get_docs:  Error! Retries exceeded.  Failed to retrieve docs of "{0}".'.format(db)
+            return None
+    except:
+        print 'get_docs:  Warning!  Doc request failed.  Retrying.'
+        request_throttle.backoff()
+        return get_docs(db, ids, session, retries)
+
+
+def store_listed(db, rows, manifest, session, counts):
+    # Takes (_id, _rev) pairs in _id order.  Only the docs whose revision the
+    # repository lacks are fetched, and every doc still there when they are
+    # is written to the manifest under the revision that was stored.
+    keys = [all_docs_repo.doc_key(db, doc_id, rev) for doc_id, rev in rows]
+    missing = [doc_id for (doc_id, rev), key in zip(rows, keys) if not repository.has(key)]
+    fetched = {}
+    if len(missing) > 0:
+        docs = get_docs(db, missing, session)
+        if docs is None:
+            return False
+        records = []
+        refs = []
+        for doc in docs:
+            key = all_docs_repo.doc_key(db, doc['_id'], doc['_rev'])
+            fetched[doc['_id']] = key
+            stubs = doc.get('_attachments') or {}
+            records.append((key, backup_common.format_doc(doc), sorted(stub['digest'] for stub in stubs.values() if 'digest' in stub)))
+            if config['attachments']:
+                refs.extend(backup_common.attachment_refs(doc))
+        if len(refs) > 0 and not save_attachments(db, refs, session):
+            return False
+        counts['new'] += repository.add(records)
+
+    lines = []
+    missing = set(missing)
+    for (doc_id, rev), key in zip(rows, keys):
+        if doc_id in missing:
+            # deleted since it was listed if it wasn't fetched
+            key = fetched.get(doc_id)
+            if key is None:
+                continue
+        lines.append(key + '\n')
+    manifest.write(''.join(lines))
+    counts['docs'] += len(lines)
+    return True
+
+
+def save_to_repo(db, session):
+    # The listing is streamed without the docs, so a database that hardly
+    # changed since the last run costs little more than its ids and revs.
+    r = session.get('{0}{1}/_all_docs'.format(config['baseurl'], db), headers=config['authheader'], stream=True)
+    if r.status_code != 200:
+        print 'Failed to list {0}!'.format(db)
+        return
+
+    manifest = repository.begin_manifest(repository.stamp, db)
+    counts = dict(docs=0, new=0)
+    splitter = backup_common.RowSplitter()
+    rows = []
+    ok = True
+    for chunk in r.iter_content(chunk_size=5000000):
+        if not chunk:
+            continue
+        for row in splitter.feed(chunk):
+            row = json.loads(row)
+            rows.append((row['id'], row['value']['rev']))
+        while ok and len(rows) >= config['repo_batch']:
+            ok = store_listed(db, rows[:config['repo_batch']], manifest, session, counts)
+            rows = rows[config['repo_batch']:]
+        if not ok:
+            break
+    if ok and len(rows) > 0:
+        ok = store_listed(db, rows, manifest, session, counts)
+
+    if not ok:
+        print 'Failed to save {0}!  It is left out of snapshot {1}.'.format(db, repository.stamp)
+        manifest.close()
+        os.remove(manifest.name)
+        return
+
+    repository.end_manifest(manifest)
+    print 'Saved {0}:  {1} docs, {2} new to the repository...'.format(db, counts['docs'], counts['new'])
+
+
+def save_db(db, session):
+    if config['repopath'] != '':
+        save_to_repo(db, session)
+        return
+
+    if isinstance(db, dict):
+        planner.save_segment(db, session)
+        return
+
+    if config['page_size'] > 0:
+        page_all_docs(db, session)
+        return
+
+    r = session.get('{0}{1}/_all_docs?include_docs=true'.format(config['baseurl'], db), headers=config['authheader'], stream=True)
+
+    refs = planner.attachment_refs()
+    with backup_common.open_output(planner.output_filename(db)) as f:
+        planner.write_stream(r, f, refs)
+    planner.index_output(planner.output_filename(db))
+
+    if refs is not None and not save_attachments(db, refs, session):
+        print 'Saved {0}, but some of its attachments could not be retrieved!'.format(db)
+        return
+    print 'Saved {0}...'.format(db)
+
+
+def stream_all_docs(queue, worker=0):
+	s = request_throttle.Session()
 	while True:
 		db = queue.get()
 		if db is None:
 			print 'End of database list reached.  Thread exiting...'
 			break
 
-		r = s.get('{0}{1}/_all_docs?include_docs=true'.format(config['baseurl'], db), headers=config['authheader'], stream=True)
-			
-		with open("{0}/{1}.json".format(config['outputpath'], db), 'wb') as f:
-			for chunk in r.iter_content(chunk_size=5000000):
-				if chunk:
-					f.write(chunk)
-					f.flush()
-
-		print 'Saved {0}...'.format(db)
+		# one failed database must not cost this worker the rest of its bin
+		start = time.time()
+		try:
+			save_db(db, s)
+		except:
+			print 'stream_all_docs:  Error!  Failed to save {0}: {1}'.format(db['db'] if isinstance(db, dict) else db, sys.exc_info()[1])
+		backup_common.record_load(worker_loads[worker], db, planner.db_weights, time.time() - start)
 
 
 def main(argv):
@@ -88,27 +478,43 @@ def main(argv):
     init_config()
     get_password()
     authenticate()
+    request_throttle.configure(config['rate_limit'], config['byte_limit'])
 
-    if not os.path.exists(config['outputpath']):
+    global repository
+    if config['repopath'] != '':
+        repository = all_docs_repo.Repository(config['repopath'])
+    elif not os.path.exists(config['outputpath']):
         os.makedirs(config['outputpath'])
 
     dbs = requests.get('{0}_all_dbs'.format(config['baseurl']), headers=config['authheader']).json()
     if '_replicator' in dbs:
         dbs.remove('_replicator')
 
-    q = multiprocessing.Queue()
-    for db in dbs:
-        q.put(db)
+    if config['schedule'] != 'none':
+        queues, predicted = planner.schedule_dbs(dbs)
+    else:
+        q = multiprocessing.Queue()
+        for task, weight in planner.plan_dbs(dbs):
+            q.put(task)
+        queues = [q] * config['num_threads']
 
     threads = []
     for i in range(config['num_threads']):
-        t = multiprocessing.Process(target=stream_all_docs, args=(q,))
+        worker_loads.append(dict(tasks=0, weight=0, seconds=0.0))
+        t = multiprocessing.Process(target=stream_all_docs, args=(queues[i], i))
         threads.append(t)
         t.start()
-        q.put(None)
+        queues[i].put(None)
 
     for t in threads:
         t.join()
 
+    if config['schedule'] != 'none':
+        backup_common.print_load_report(worker_loads, predicted)
+
+    if repository is not None:
+        repository.close()
+        print 'Snapshot {0} written to {1}.'.format(repository.stamp, config['repopath'])
+
 if __name__ == "__main__":
 	main(sys.argv[1:])
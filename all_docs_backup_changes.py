@@ -7,6 +7,9 @@ import sys
 import getopt
 import getpass
 
+import backup_common
+import request_throttle
+
 
 # configuration values
 config = dict(
@@ -16,18 +19,42 @@ config = dict(
     outputpath = './all_docs_output_{0}'.format(int(time.time())),
     checkpointpath = '.db_changes_checkpoint',
     tmpcheckpointpath = '.db_changes_checkpoint.tmp',
+    seqcheckpointpath = '.db_seq_checkpoint',
     authheader = '',
     num_threads = 20,
     baseurl = '',
-    incremental = False
+    incremental = False,
+    # databases with more docs than this are fetched as parallel key ranges; 0 disables
+    split_threshold = 0,
+    # compression applied to the output files: none, gzip or zstd
+    codec = 'none',
+    # order of the work queue: none (as listed), size (largest first) or binpack (per worker)
+    schedule = 'none',
+    # output format: json (the _all_docs response) or ndjson (one document per line)
+    format = 'json',
+    # write a sorted _id index next to every backup file, see all_docs_lookup.py
+    index = False,
+    # back up only the _changes of each database since its last checkpointed seq
+    delta = False,
+    # rows requested per _changes page in delta mode
+    changes_limit = 10000,
+    # process wide request and byte rates, see request_throttle.py; 0 is unlimited
+    rate_limit = 0,
+    byte_limit = 0
     )
 
-usage = 'python ' + os.path.basename(__file__) + ' -a <accountname> [-u <username>] [-b <base url>] [-i]'
+# what each worker actually got through
+worker_loads = []
+
+# last backed up update seq of each database, used as the since value in delta mode
+db_seqs = {}
+
+usage = 'python ' + os.path.basename(__file__) + ' -a <accountname> [-u <username>] [-b <base url>] [-i] [-d] [-s <docs>] [-c <none|gzip|zstd>] [-S <none|size|binpack>] [-f <json|ndjson>] [-x] [--ratelimit=<requests/sec>] [--bytelimit=<bytes/sec>]'
 
 def parse_args(argv):
     # parse through the argument list and update the config dict as appropriate
     try:
-        opts, args = getopt.getopt(argv, "hu:a:b:i", ["help", "username=", "accountname=", "url=", "incremental"])
+        opts, args = getopt.getopt(argv, "hu:a:b:ids:c:S:f:x", ["help", "username=", "accountname=", "url=", "incremental", "delta", "split=", "compress=", "schedule=", "format=", "index", "ratelimit=", "bytelimit="])
     except getopt.GetoptError:
         print usage
         sys.exit(2)
@@ -43,6 +70,23 @@ def parse_args(argv):
             config['baseurl'] = arg
         elif opt in ("-i", "--incremental"):
             config['incremental'] = True
+        elif opt in ("-d", "--delta"):
+            config['incremental'] = True
+            config['delta'] = True
+        elif opt in ("-s", "--split"):
+            config['split_threshold'] = int(arg)
+        elif opt in ("-c", "--compress"):
+            config['codec'] = arg
+        elif opt in ("-S", "--schedule"):
+            config['schedule'] = arg
+        elif opt in ("-f", "--format"):
+            config['format'] = arg
+        elif opt in ("-x", "--index"):
+            config['index'] = True
+        elif opt == "--ratelimit":
+            config['rate_limit'] = float(arg)
+        elif opt == "--bytelimit":
+            config['byte_limit'] = int(arg)
 
 
 def init_config():
@@ -51,6 +95,21 @@ def init_config():
         sys.exit()
     if config['username'] == '':
         config['username'] = config['accountname']
+    if config['codec'] not in backup_common.codec_suffixes:
+        print usage
+        sys.exit()
+    if config['schedule'] not in ['none', 'size', 'binpack']:
+        print usage
+        sys.exit()
+    if config['format'] not in ['json', 'ndjson']:
+        print usage
+        sys.exit()
+    if config['index'] and config['codec'] != 'none':
+        print 'Only uncompressed backups can be indexed.'
+        sys.exit()
+    if config['codec'] == 'zstd' and backup_common.zstandard is None:
+        print 'The zstandard module is required for zstd output.  Try "pip install zstandard".'
+        sys.exit()
     # if no URL was specified, assumed this is DBaaS
     if config['baseurl'] == '':
         config['baseurl'] = 'https://{0}.cloudant.com/'.format(config['accountname'])
@@ -58,6 +117,7 @@ def init_config():
     if os.path.dirname(__file__) != '':
         config['checkpointpath'] = '{0}/.db_changes_checkpoint'.format(os.path.dirname(__file__))
         config['tmpcheckpointpath'] = '{0}/.db_changes_checkpoint.tmp'.format(os.path.dirname(__file__))
+        config['seqcheckpointpath'] = '{0}/.db_seq_checkpoint'.format(os.path.dirname(__file__))
 
 
 def get_password():
@@ -77,23 +137,116 @@ def authenticate():
     config['authheader'] = {'Cookie': response.headers['set-cookie']}
 
 
-def stream_all_docs(queue):
-    s = requests.Session()
+def delta_filename(db):
+    return '{0}/{1}.delta.{2}{3}'.format(config['outputpath'], db, config['format'], backup_common.codec_suffixes[config['codec']])
+
+
+def read_db_seqs():
+    if not os.path.exists(config['seqcheckpointpath']):
+        return {}
+    with open(config['seqcheckpointpath'], 'r') as f:
+        return json.load(f)
+
+
+def write_db_seqs():
+    with open(config['seqcheckpointpath'] + '.tmp', 'w') as f:
+        f.write(json.dumps(db_seqs))
+    os.rename(config['seqcheckpointpath'] + '.tmp', config['seqcheckpointpath'])
+
+
+def record_seq(db, seq):
+    if config['delta']:
+        db_seqs[db] = seq
+
+
+def is_delta(db):
+    # deltas are tiny next to full backups, so there is nothing to size or split
+    return config['delta'] and db in db_seqs
+
+
+# sizes, splits and saves the databases, see backup_common.BackupPlanner
+planner = backup_common.BackupPlanner(config, skip=is_delta, saved=lambda db, info: record_seq(db, info['update_seq']))
+
+
+def save_delta(db, session):
+    # Page through _changes since the last checkpointed seq.  The delta file
+    # keeps one row (or document) per line like a full backup, so
+    # all_docs_restore.py can apply it on top of the base and deletions come
+    # across as tombstones.
+    since = db_seqs[db]
+    count = 0
+    filename = delta_filename(db)
+    with backup_common.open_output(filename) as f:
+        if config['format'] == 'json':
+            f.write('{{"since":{0},"rows":['.format(json.dumps(since)))
+        while True:
+            params = {'include_docs': 'true', 'style': 'all_docs', 'since': since, 'limit': config['changes_limit']}
+            r = session.get('{0}{1}/_changes'.format(config['baseurl'], db), headers=config['authheader'], params=params)
+            if r.status_code != 200:
+                break
+            page = r.json()
+            for row in page['results']:
+                if config['format'] == 'ndjson':
+                    f.write(backup_common.format_doc(row['doc']))
+                else:
+                    f.write((',\n' if count > 0 else '\n') + json.dumps(row))
+                count += 1
+            since = page['last_seq']
+            if len(page['results']) < config['changes_limit']:
+                break
+        if config['format'] == 'json':
+            f.write('\n]}\n')
+
+    if r.status_code != 200:
+        print 'Failed to retrieve the changes for {0}!'.format(db)
+        print json.dumps(r.json(), indent=4)
+        os.remove(filename)
+        return
+
+    planner.index_output(filename)
+    record_seq(db, since)
+    print 'Saved {0} changes for {1}...'.format(count, db)
+
+
+def save_db(db, session):
+    if isinstance(db, dict):
+        planner.save_segment(db, session)
+        return
+
+    info = None
+    if config['delta']:
+        if is_delta(db):
+            save_delta(db, session)
+            return
+        # no checkpoint yet, so take a full backup and start the deltas from here
+        info = planner.get_db_info(db, session)
+
+    r = session.get('{0}{1}/_all_docs?include_docs=true'.format(config['baseurl'], db), headers=config['authheader'], stream=True)
+
+    if r.status_code == 200:
+        with backup_common.open_output(planner.output_filename(db)) as f:
+            planner.write_stream(r, f)
+        planner.index_output(planner.output_filename(db))
+
+        if info is not None:
+            record_seq(db, info['update_seq'])
+        print 'Saved {0}...'.format(db)
+
+
+def stream_all_docs(queue, worker=0):
+    s = request_throttle.Session()
     while True:
         db = queue.get()
         if db is None:
             break
 
-        r = s.get('{0}{1}/_all_docs?include_docs=true'.format(config['baseurl'], db), headers=config['authheader'], stream=True)
-
-        if r.status_code == 200:
-            with open("{0}/{1}.json".format(config['outputpath'], db), 'wb') as f:
-    			for chunk in r.iter_content(chunk_size=5000000):
-    				if chunk:
-    					f.write(chunk)
-    					f.flush()
-
-            print 'Saved {0}...'.format(db)
+        # one failed database must not cost this worker the rest of its bin
+        start = time.time()
+        try:
+            save_db(db, s)
+        except:
+            print 'stream_all_docs:  Error!  Failed to save {0}: {1}'.format(db['db'] if isinstance(db, dict) else db, sys.exc_info()[1])
+        backup_common.record_load(worker_loads[worker], db, planner.db_weights, time.time() - start)
 
 
 def write_checkpoint(seq_obj):
@@ -103,7 +256,7 @@ def write_checkpoint(seq_obj):
 
 
 def get_dbs():
-    q = multiprocessing.Queue()
+    dbs = []
     unique = set()
 
     # if a checkpoint exists, run _db_updates with since parameter, otherwise just run _db_updates
@@ -118,7 +271,7 @@ def get_dbs():
             db = db_object['dbname']
             if db not in ['_replicator','metrics','dbs'] and db not in unique:
                 unique.add(db)
-                q.put(db)
+                dbs.append(db)
 
     else:
         # we need to get the latest sequence number to prepare for future incrementals
@@ -130,13 +283,13 @@ def get_dbs():
             write_checkpoint(r.json())
 
         # now we grab all the databases in the account.
-        dbs = requests.get('{0}_all_dbs'.format(config['baseurl']), headers=config['authheader']).json()
-        for db in dbs:
+        all_dbs = requests.get('{0}_all_dbs'.format(config['baseurl']), headers=config['authheader']).json()
+        for db in all_dbs:
             if db not in ['_replicator', 'metrics', 'dbs']:
-                q.put(db)
+                dbs.append(db)
 
-    # return the queue of databses
-    return q
+    # return the list of databases
+    return dbs
 
 
 def remove_tmp_checkpoint():
@@ -154,26 +307,44 @@ def main(argv):
     init_config()
     get_password()
     authenticate()
+    request_throttle.configure(config['rate_limit'], config['byte_limit'])
     remove_tmp_checkpoint()
 
     if not os.path.exists(config['outputpath']):
         os.makedirs(config['outputpath'])
 
+    if config['delta']:
+        db_seqs.update(read_db_seqs())
+
     # get databases slated for backup
-    q = get_dbs()
+    dbs = get_dbs()
+
+    if config['schedule'] != 'none':
+        queues, predicted = planner.schedule_dbs(dbs)
+    else:
+        q = multiprocessing.Queue()
+        for task, weight in planner.plan_dbs(dbs):
+            q.put(task)
+        queues = [q] * config['num_threads']
 
     # break up the processing across multiple threads
     threads = []
     for i in range(config['num_threads']):
-        t = multiprocessing.Process(target=stream_all_docs, args=(q,))
+        worker_loads.append(dict(tasks=0, weight=0, seconds=0.0))
+        t = multiprocessing.Process(target=stream_all_docs, args=(queues[i], i))
         threads.append(t)
         t.start()
-        q.put(None)
+        queues[i].put(None)
 
     for t in threads:
         t.join()
 
+    if config['schedule'] != 'none':
+        backup_common.print_load_report(worker_loads, predicted)
+
     rename_checkpoint_file()
+    if config['delta']:
+        write_db_seqs()
 
 if __name__ == "__main__":
 	main(sys.argv[1:])
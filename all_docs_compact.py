@@ -0,0 +1,128 @@
+import json
+import os
+import sys
+import getopt
+
+import backup_common
+
+
+# configuration values
+config = dict(
+    basepath = '',
+    # delta files from all_docs_backup_changes.py -d, oldest first
+    deltapaths = [],
+    outputpath = '',
+    )
+
+usage = 'python ' + os.path.basename(__file__) + ' -b <base backup file> -d <delta file> [-d <delta file> ...] -o <output file>'
+
+
+def parse_args(argv):
+    # parse through the argument list and update the config dict as appropriate
+    try:
+        opts, args = getopt.getopt(argv, "hb:d:o:", ["help", "base=", "delta=", "output="])
+    except getopt.GetoptError:
+        print usage
+        sys.exit(2)
+    for opt, arg in opts:
+        if opt == '-h':
+            print usage
+            sys.exit()
+        elif opt in ("-b", "--base"):
+            config['basepath'] = arg
+        elif opt in ("-d", "--delta"):
+            config['deltapaths'].append(arg)
+        elif opt in ("-o", "--output"):
+            config['outputpath'] = arg
+
+
+def init_config():
+    if config['basepath'] == '' or config['outputpath'] == '' or len(config['deltapaths']) == 0:
+        print usage
+        sys.exit()
+    if backup_common.zstandard is None and config['outputpath'].endswith('.zst'):
+        print 'The zstandard module is required for zstd output.  Try "pip install zstandard".'
+        sys.exit()
+
+
+def iter_rows(filename):
+    # backups and deltas both hold one row per line between a header and a
+    # trailer, or one document per line when they were written as NDJSON
+    f = backup_common.open_backup(filename)
+    ndjson = '.ndjson' in filename
+    for line in f:
+        line = line.strip()
+        if line.endswith(','):
+            line = line[:-1]
+        try:
+            row = json.loads(line)
+        except ValueError:
+            continue
+        if ndjson:
+            yield {'id': row['_id'], 'doc': row}
+        elif 'doc' in row:
+            yield row
+    f.close()
+
+
+def load_deltas():
+    # later deltas win, so the map ends up holding the newest revision of every changed doc
+    changes = {}
+    for path in config['deltapaths']:
+        count = 0
+        for row in iter_rows(path):
+            changes[row['id']] = row['doc']
+            count += 1
+        print 'Read {0} changes from {1}...'.format(count, path)
+    return changes
+
+
+def all_docs_row(doc):
+    return json.dumps({'id': doc['_id'], 'key': doc['_id'], 'value': {'rev': doc['_rev']}, 'doc': doc})
+
+
+def write_doc(f, doc, written):
+    if '.ndjson' in config['outputpath']:
+        f.write(backup_common.format_doc(doc))
+    else:
+        f.write((',\n' if written > 0 else '\n') + all_docs_row(doc))
+
+
+def compact():
+    changes = load_deltas()
+    written = 0
+
+    with backup_common.open_output(config['outputpath']) as f:
+        if '.ndjson' not in config['outputpath']:
+            f.write('{"offset":0,"rows":[')
+
+        # stream the base, swapping in the newer revision of any changed doc
+        for row in iter_rows(config['basepath']):
+            doc = changes.pop(row['id'], row['doc'])
+            if doc.get('_deleted'):
+                continue
+            write_doc(f, doc, written)
+            written += 1
+
+        # whatever is left was created after the base was taken
+        for doc_id in sorted(changes):
+            doc = changes[doc_id]
+            if doc.get('_deleted'):
+                continue
+            write_doc(f, doc, written)
+            written += 1
+
+        if '.ndjson' not in config['outputpath']:
+            f.write('\n]}\n')
+
+    print 'Wrote {0} documents to {1}.'.format(written, config['outputpath'])
+
+
+def main(argv):
+    parse_args(argv)
+    init_config()
+    compact()
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,232 @@
+import json
+import os
+import sys
+import getopt
+import mmap
+import struct
+
+
+# configuration values
+config = dict(
+    inputpath = '',
+    build = False,
+    docid = None,
+    startkey = None,
+    endkey = None,
+    prefix = None,
+    )
+
+usage = 'python ' + os.path.basename(__file__) + ' -p <backup file> [-b] [-i <id>] [-s <startkey>] [-e <endkey>] [-x <prefix>]'
+
+# Index layout, all integers little endian:
+#   header   8 byte magic, uint64 record count
+#   table    one uint64 file position per record, in key order
+#   records  uint32 key length, utf-8 _id, uint64 offset and uint32 length of the doc in the backup
+INDEX_MAGIC = 'CLDXIDX1'
+HEADER = struct.Struct('<8sQ')
+POSITION = struct.Struct('<Q')
+KEY_LENGTH = struct.Struct('<I')
+SPAN = struct.Struct('<QI')
+
+
+def parse_args(argv):
+    # parse through the argument list and update the config dict as appropriate
+    try:
+        opts, args = getopt.getopt(argv, "hp:bi:s:e:x:", ["help", "path=", "build", "id=", "startkey=", "endkey=", "prefix="])
+    except getopt.GetoptError:
+        print usage
+        sys.exit(2)
+    for opt, arg in opts:
+        if opt == '-h':
+            print usage
+            sys.exit()
+        elif opt in ("-p", "--path"):
+            config['inputpath'] = arg
+        elif opt in ("-b", "--build"):
+            config['build'] = True
+        elif opt in ("-i", "--id"):
+            config['docid'] = arg
+        elif opt in ("-s", "--startkey"):
+            config['startkey'] = arg
+        elif opt in ("-e", "--endkey"):
+            config['endkey'] = arg
+        elif opt in ("-x", "--prefix"):
+            config['prefix'] = arg
+
+
+def init_config():
+    if config['inputpath'] == '':
+        print usage
+        sys.exit()
+    if config['inputpath'].endswith('.gz') or config['inputpath'].endswith('.zst'):
+        print 'Only uncompressed backups can be indexed.'
+        sys.exit()
+
+
+def index_filename(filename):
+    # hidden so that all_docs_restore.py does not mistake it for a database file
+    head, tail = os.path.split(filename)
+    return os.path.join(head, '.{0}.idx'.format(tail))
+
+
+def encode_key(key):
+    if isinstance(key, unicode):
+        return key.encode('utf-8')
+    return key
+
+
+def id_in_range(doc_id, startkey=None, endkey=None, prefix=None):
+    # ids compare as utf-8 bytes, the same order the index is sorted in
+    key = encode_key(doc_id)
+    if prefix is not None and not key.startswith(encode_key(prefix)):
+        return False
+    if startkey is not None and key < encode_key(startkey):
+        return False
+    if endkey is not None and key >= encode_key(endkey):
+        return False
+    return True
+
+
+def iter_spans(filename):
+    # Yields (_id, offset, length) for every doc in an uncompressed backup.
+    # NDJSON backups hold one doc per line, and _all_docs backups one row per
+    # line between the header and the trailer.
+    ndjson = '.ndjson' in filename
+    offset = 0
+    with open(filename, 'rb') as f:
+        for line in f:
+            text = line.rstrip()
+            if text.endswith(','):
+                text = text[:-1]
+            try:
+                row = json.loads(text)
+            except ValueError:
+                row = None
+            if ndjson and row is not None:
+                yield row['_id'], offset, len(text)
+            elif row is not None and row.get('doc') is not None:
+                yield row['id'], offset, len(text)
+            offset += len(line)
+
+
+def build_index(filename):
+    entries = sorted((encode_key(doc_id), offset, length) for doc_id, offset, length in iter_spans(filename))
+
+    tmp = index_filename(filename) + '.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(HEADER.pack(INDEX_MAGIC, len(entries)))
+        position = HEADER.size + POSITION.size * len(entries)
+        for key, offset, length in entries:
+            f.write(POSITION.pack(position))
+            position += KEY_LENGTH.size + len(key) + SPAN.size
+        for key, offset, length in entries:
+            f.write(KEY_LENGTH.pack(len(key)) + key + SPAN.pack(offset, length))
+    os.rename(tmp, index_filename(filename))
+    return len(entries)
+
+
+class BackupIndex(object):
+    # Binary searches the sorted index of a backup through mmap, then reads
+    # the matching docs straight out of the mapped backup file.
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.index_file = open(index_filename(filename), 'rb')
+        self.index = mmap.mmap(self.index_file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.count = HEADER.unpack_from(self.index, 0)
+        if magic != INDEX_MAGIC:
+            raise ValueError('{0} is not a backup index'.format(index_filename(filename)))
+        self.backup_file = open(filename, 'rb')
+        self.backup = None
+        if os.path.getsize(filename) > 0:
+            self.backup = mmap.mmap(self.backup_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def close(self):
+        self.index.close()
+        self.index_file.close()
+        if self.backup is not None:
+            self.backup.close()
+        self.backup_file.close()
+
+    def record(self, i):
+        position = POSITION.unpack_from(self.index, HEADER.size + POSITION.size * i)[0]
+        key_length = KEY_LENGTH.unpack_from(self.index, position)[0]
+        start = position + KEY_LENGTH.size
+        offset, length = SPAN.unpack_from(self.index, start + key_length)
+        return self.index[start:start + key_length], offset, length
+
+    def bisect(self, key):
+        # first record whose key is >= key
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.record(mid)[0] < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def read_span(self, offset, length):
+        return self.backup[offset:offset + length]
+
+    def read_doc(self, offset, length):
+        row = json.loads(self.read_span(offset, length))
+        if 'doc' in row and 'id' in row:
+            return row['doc']
+        return row
+
+    def get(self, doc_id):
+        key = encode_key(doc_id)
+        i = self.bisect(key)
+        if i < self.count:
+            found, offset, length = self.record(i)
+            if found == key:
+                return self.read_doc(offset, length)
+        return None
+
+    def iter_spans(self, startkey=None, endkey=None, prefix=None):
+        start = encode_key(startkey) if startkey is not None else ''
+        if prefix is not None and encode_key(prefix) > start:
+            start = encode_key(prefix)
+        i = self.bisect(start)
+        while i < self.count:
+            key, offset, length = self.record(i)
+            if endkey is not None and key >= encode_key(endkey):
+                break
+            if prefix is not None and not key.startswith(encode_key(prefix)):
+                break
+            yield offset, length
+            i += 1
+
+    def iter_docs(self, startkey=None, endkey=None, prefix=None):
+        for offset, length in self.iter_spans(startkey, endkey, prefix):
+            yield self.read_doc(offset, length)
+
+
+def has_index(filename):
+    return os.path.exists(index_filename(filename))
+
+
+def main(argv):
+    parse_args(argv)
+    init_config()
+
+    if config['build'] or not has_index(config['inputpath']):
+        count = build_index(config['inputpath'])
+        print >> sys.stderr, 'Indexed {0} documents in {1}.'.format(count, config['inputpath'])
+
+    index = BackupIndex(config['inputpath'])
+    if config['docid'] is not None:
+        doc = index.get(config['docid'])
+        if doc is None:
+            print >> sys.stderr, 'Document "{0}" was not found.'.format(config['docid'])
+            sys.exit(1)
+        print json.dumps(doc, separators=(',', ':'))
+    elif config['startkey'] is not None or config['endkey'] is not None or config['prefix'] is not None:
+        for doc in index.iter_docs(config['startkey'], config['endkey'], config['prefix']):
+            print json.dumps(doc, separators=(',', ':'))
+    index.close()
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
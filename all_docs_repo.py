@@ -0,0 +1,495 @@
+import json
+import os
+import sys
+import getopt
+import fcntl
+import hashlib
+import heapq
+import mmap
+import struct
+import threading
+import time
+
+import backup_common
+
+
+# configuration values
+config = dict(
+    repopath = '',
+    list = False,
+    # snapshot to write out as a directory of NDJSON backups, one file per database
+    snapshot = None,
+    outputpath = '',
+    # prune all but this many of the newest snapshots; 0 keeps them all
+    keep = 0,
+    # snapshots to prune by name
+    drop = [],
+    )
+
+usage = 'python ' + os.path.basename(__file__) + ' -r <repository> [-l] [-m <snapshot> -o <output dir>] [-k <# of snapshots to keep>] [--drop=<snapshot>]'
+
+# Repository layout, see all_docs_backup.py -R:
+#   packs/<name>.pack        documents as NDJSON lines, appended to by one backup run
+#   packs/<name>.idx         one JSON line per document: [key, offset, length, attachment digests]
+#   packs/<name>.keys        the keys of the pack sorted, written once the pack is closed
+#   keys.index               the keys of every pack sorted, merged from their .keys files
+#   snapshots/<run>/<db>.manifest
+#                            the key of every document of a database in _id order
+#   .attachments/            attachment bodies, laid out as all_docs_backup.py -A writes them
+# Keys are the sha1 of a document's database, _id and _rev, so an unchanged
+# document is stored once no matter how many snapshots refer to it.  The
+# database is part of the key because a _rev is only unique within one.
+
+# a pack is closed and a new one started once it grows past this
+PACK_BYTES = 268435456
+# prune rewrites a pack once less than this fraction of its bytes is still referenced
+REWRITE_BELOW = 0.5
+
+# keys.index is a header, the pack names as JSON, then fixed size records
+# sorted by key: the sha1 as raw bytes, the pack's place in the names, and
+# the document's offset and length in the pack
+INDEX_MAGIC = 'CLDXKEY1'
+INDEX_HEADER = struct.Struct('<8sQI')
+INDEX_RECORD = struct.Struct('<20sIQI')
+# a .keys file is just the records of one pack, without the pack number
+PACK_RECORD = struct.Struct('<20sQI')
+
+
+def parse_args(argv):
+    # parse through the argument list and update the config dict as appropriate
+    try:
+        opts, args = getopt.getopt(argv, "hr:lm:o:k:", ["help", "repo=", "list", "materialize=", "output=", "keep=", "drop="])
+    except getopt.GetoptError:
+        print usage
+        sys.exit(2)
+    for opt, arg in opts:
+        if opt == '-h':
+            print usage
+            sys.exit()
+        elif opt in ("-r", "--repo"):
+            config['repopath'] = arg
+        elif opt in ("-l", "--list"):
+            config['list'] = True
+        elif opt in ("-m", "--materialize"):
+            config['snapshot'] = arg
+        elif opt in ("-o", "--output"):
+            config['outputpath'] = arg
+        elif opt in ("-k", "--keep"):
+            config['keep'] = int(arg)
+        elif opt == "--drop":
+            config['drop'].append(arg)
+
+
+def init_config():
+    if config['repopath'] == '' or not os.path.isdir(config['repopath']):
+        print usage
+        sys.exit()
+    if config['snapshot'] is not None and config['outputpath'] == '':
+        print usage
+        sys.exit()
+
+
+def doc_key(db, doc_id, rev):
+    return hashlib.sha1(json.dumps([db, doc_id, rev])).hexdigest()
+
+
+def write_pack_keys(path, entries):
+    # takes (key, offset, length) triples; hex keys sort the same as their bytes
+    with open(path + '.tmp', 'wb') as f:
+        for key, offset, length in sorted(entries):
+            f.write(PACK_RECORD.pack(key.decode('hex'), offset, length))
+        f.flush()
+        os.fsync(f.fileno())
+    os.rename(path + '.tmp', path)
+
+
+def iter_pack_keys(path, number):
+    with open(path, 'rb') as f:
+        while True:
+            data = f.read(PACK_RECORD.size * 4096)
+            if not data:
+                break
+            for i in range(0, len(data), PACK_RECORD.size):
+                key, offset, length = PACK_RECORD.unpack_from(data, i)
+                yield key, number, offset, length
+
+
+class KeyIndex(object):
+    # The keys of every pack in one sorted file, binary searched through
+    # mmap like the backup indexes of all_docs_lookup.py, so a repository
+    # is opened without reading its keys into memory.
+
+    def __init__(self, path):
+        self.path = path
+        self.names = []
+        self.count = 0
+        self.file = None
+        self.map = None
+        if not os.path.exists(path):
+            return
+        self.file = open(path, 'rb')
+        magic, self.count, names_length = INDEX_HEADER.unpack(self.file.read(INDEX_HEADER.size))
+        if magic != INDEX_MAGIC:
+            raise ValueError('{0} is not a repository key index'.format(path))
+        self.names = json.loads(self.file.read(names_length))
+        self.start = INDEX_HEADER.size + names_length
+        if self.count > 0:
+            self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def close(self):
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def record(self, i):
+        return INDEX_RECORD.unpack_from(self.map, self.start + INDEX_RECORD.size * i)
+
+    def find(self, key):
+        # (pack name, offset, length) of a hex key, or None
+        if self.count == 0:
+            return None
+        key = key.decode('hex')
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.record(mid)[0] < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < self.count:
+            found, number, offset, length = self.record(lo)
+            if found == key:
+                return self.names[number], offset, length
+        return None
+
+    def __iter__(self):
+        for i in range(self.count):
+            yield self.record(i)
+
+
+def update_key_index(path, packs_path, names):
+    # Merges the .keys of the packs the index doesn't cover yet into it, one
+    # record per source in memory at a time.  If a pack it covers is gone it
+    # is rebuilt from the .keys of every pack.  A key stored in more than one
+    # pack is found in the one listed first.
+    index = KeyIndex(path)
+    if set(index.names) == set(names):
+        return index
+    if set(index.names) <= set(names):
+        merged = index.names + [name for name in names if name not in index.names]
+        sources = [iter(index)]
+        added = merged[len(index.names):]
+    else:
+        merged = names
+        sources = []
+        added = names
+    for name in added:
+        sources.append(iter_pack_keys(os.path.join(packs_path, name + '.keys'), merged.index(name)))
+
+    names_json = json.dumps(merged)
+    count = 0
+    last = None
+    with open(path + '.tmp', 'wb') as f:
+        f.write(INDEX_HEADER.pack(INDEX_MAGIC, 0, len(names_json)) + names_json)
+        records = []
+        for record in heapq.merge(*sources):
+            if record[0] == last:
+                continue
+            last = record[0]
+            records.append(INDEX_RECORD.pack(*record))
+            count += 1
+            if len(records) >= 4096:
+                f.write(''.join(records))
+                records = []
+        f.write(''.join(records))
+        f.seek(0)
+        f.write(INDEX_HEADER.pack(INDEX_MAGIC, count, len(names_json)))
+        f.flush()
+        os.fsync(f.fileno())
+    index.close()
+    os.rename(path + '.tmp', path)
+    return KeyIndex(path)
+
+
+class Repository(object):
+    # Content addressed store shared by every backup run.  Packs are only
+    # ever appended to, and the index of a pack is written after the
+    # documents it points at are on disk, so a crash leaves at most some
+    # unreferenced bytes at the end of a pack.  One process at a time: a
+    # backup and a prune hold an exclusive lock on the repository while open,
+    # so collect() can't delete a pack a running backup still refers to.
+    # Only the keys of the open pack are held in memory.  The packs this run
+    # has closed are not looked in until the next run merges them into the
+    # key index, which at worst stores a document twice.
+
+    def __init__(self, path):
+        self.path = path
+        self.packs_path = os.path.join(path, 'packs')
+        self.snapshots_path = os.path.join(path, 'snapshots')
+        for directory in [self.packs_path, self.snapshots_path]:
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+        self.lock_file = open(os.path.join(path, 'lock'), 'a')
+        try:
+            fcntl.flock(self.lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError:
+            print 'Repository {0} is in use by another backup or prune!'.format(path)
+            sys.exit(1)
+        # names the packs and the snapshot of this run
+        self.stamp = str(int(time.time()))
+        # (pack name, offset, length) of every key in the open pack
+        self.entries = {}
+        self.lock = threading.Lock()
+        self.pack = None
+        self.pack_count = 0
+        self.readers = {}
+        for name in self.pack_names():
+            if not os.path.exists(os.path.join(self.packs_path, name + '.keys')):
+                # the pack of a run that stopped before it was closed
+                self.write_keys(name, ((record[0], record[1], record[2]) for record in self.read_pack_index(name)))
+        self.index = update_key_index(os.path.join(path, 'keys.index'), self.packs_path, self.pack_names())
+
+    def pack_names(self):
+        return sorted(f[:-len('.idx')] for f in os.listdir(self.packs_path) if f.endswith('.idx'))
+
+    def read_pack_index(self, name):
+        with open(os.path.join(self.packs_path, name + '.idx'), 'rb') as f:
+            for line in f:
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    # the torn last line of an interrupted run
+                    continue
+
+    def write_keys(self, name, entries):
+        write_pack_keys(os.path.join(self.packs_path, name + '.keys'), entries)
+
+    def lookup(self, key):
+        # (pack name, offset, length) of a stored key, or None
+        return self.entries.get(key) or self.index.find(key)
+
+    def has(self, key):
+        return self.lookup(key) is not None
+
+    def start_pack(self, prefix):
+        self.close_pack()
+        name = '{0}-{1:05d}'.format(prefix, self.pack_count)
+        while os.path.exists(os.path.join(self.packs_path, name + '.idx')):
+            self.pack_count += 1
+            name = '{0}-{1:05d}'.format(prefix, self.pack_count)
+        self.pack_count += 1
+        self.pack = dict(name=name, size=0,
+                         data=open(os.path.join(self.packs_path, name + '.pack'), 'ab'),
+                         index=open(os.path.join(self.packs_path, name + '.idx'), 'ab'))
+
+    def add(self, records, prefix=None):
+        # Appends the (key, line, attachment digests) records that aren't stored yet
+        return self.append([record for record in records if self.index.find(record[0]) is None], prefix)
+
+    def append(self, records, prefix=None):
+        # Each call is one write and fsync of the pack, then the index.  Keys
+        # already in the open pack are skipped.
+        with self.lock:
+            if self.pack is None or self.pack['size'] >= PACK_BYTES:
+                self.start_pack(prefix or self.stamp)
+            pack = self.pack
+            data = []
+            index = []
+            for key, line, digests in records:
+                if key in self.entries:
+                    continue
+                self.entries[key] = (pack['name'], pack['size'], len(line))
+                index.append(json.dumps([key, pack['size'], len(line), digests]) + '\n')
+                data.append(line)
+                pack['size'] += len(line)
+            if len(data) == 0:
+                return 0
+            pack['data'].write(''.join(data))
+            pack['data'].flush()
+            os.fsync(pack['data'].fileno())
+            pack['index'].write(''.join(index))
+            pack['index'].flush()
+            os.fsync(pack['index'].fileno())
+            return len(data)
+
+    def read(self, key):
+        name, offset, length = self.lookup(key)
+        return self.read_at(name, offset, length)
+
+    def read_at(self, name, offset, length):
+        if name not in self.readers:
+            self.readers[name] = open(os.path.join(self.packs_path, name + '.pack'), 'rb')
+        f = self.readers[name]
+        f.seek(offset)
+        return f.read(length)
+
+    def close_pack(self):
+        if self.pack is not None:
+            self.pack['data'].close()
+            self.pack['index'].close()
+            self.write_keys(self.pack['name'], ((key, entry[1], entry[2]) for key, entry in self.entries.items()))
+            self.pack = None
+            self.entries = {}
+
+    def close(self):
+        self.close_pack()
+        for f in self.readers.values():
+            f.close()
+        self.readers = {}
+        self.index.close()
+        # closing the file releases the lock
+        self.lock_file.close()
+
+    def snapshots(self):
+        return sorted(os.listdir(self.snapshots_path))
+
+    def manifest_path(self, snapshot, db):
+        return os.path.join(self.snapshots_path, snapshot, db + '.manifest')
+
+    def begin_manifest(self, snapshot, db):
+        # written under a temporary name, so only databases that were saved whole show up
+        directory = os.path.join(self.snapshots_path, snapshot)
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                # another thread created it first
+                pass
+        return open(self.manifest_path(snapshot, db) + '.tmp', 'wb')
+
+    def end_manifest(self, f):
+        f.flush()
+        os.fsync(f.fileno())
+        f.close()
+        os.rename(f.name, f.name[:-len('.tmp')])
+
+    def manifests(self, snapshot):
+        return sorted(f[:-len('.manifest')] for f in os.listdir(os.path.join(self.snapshots_path, snapshot)) if f.endswith('.manifest'))
+
+    def iter_manifest(self, snapshot, db):
+        with open(self.manifest_path(snapshot, db), 'rb') as f:
+            for line in f:
+                yield line.rstrip('\n')
+
+
+def list_snapshots(repo):
+    total = 0
+    for snapshot in repo.snapshots():
+        dbs = repo.manifests(snapshot)
+        docs = sum(sum(1 for key in repo.iter_manifest(snapshot, db)) for db in dbs)
+        print '{0}  ({1}):  {2} databases, {3} documents'.format(
+            snapshot, time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(int(snapshot))), len(dbs), docs)
+        total += docs
+    size = sum(os.path.getsize(os.path.join(repo.packs_path, name + '.pack')) for name in repo.pack_names())
+    print '{0} documents referenced, {1} stored in {2} packs ({3:.1f} MB).'.format(total, repo.index.count, len(repo.pack_names()), size / 1048576.0)
+
+
+def materialize(repo, snapshot, outputpath):
+    # writes NDJSON backups that all_docs_restore.py reads like any other
+    if snapshot not in repo.snapshots():
+        print 'There is no snapshot "{0}" in {1}.'.format(snapshot, repo.path)
+        sys.exit(1)
+    if not os.path.exists(outputpath):
+        os.makedirs(outputpath)
+    for db in repo.manifests(snapshot):
+        written = 0
+        missing = 0
+        with open(os.path.join(outputpath, db + '.ndjson'), 'wb') as f:
+            for key in repo.iter_manifest(snapshot, db):
+                if not repo.has(key):
+                    missing += 1
+                    continue
+                f.write(repo.read(key))
+                written += 1
+        print 'Wrote {0} documents of {1}.'.format(written, db)
+        if missing > 0:
+            print 'Warning!  {0} documents of {1} are missing from the repository.'.format(missing, db)
+    if os.path.isdir(os.path.join(repo.path, '.attachments')):
+        print 'Restore with --attachments={0} to bring back attachment bodies.'.format(os.path.join(repo.path, '.attachments'))
+
+
+def drop_snapshots(repo, keep, drop):
+    snapshots = repo.snapshots()
+    doomed = [s for s in snapshots if s in drop]
+    if keep > 0:
+        doomed.extend(s for s in snapshots[:-keep] if s not in doomed)
+    for snapshot in doomed:
+        directory = os.path.join(repo.snapshots_path, snapshot)
+        for f in os.listdir(directory):
+            os.remove(os.path.join(directory, f))
+        os.rmdir(directory)
+        print 'Dropped snapshot {0}.'.format(snapshot)
+    return len(doomed)
+
+
+def collect(repo):
+    # Packs nothing refers to any more are deleted.  Packs that are mostly
+    # unreferenced have their live documents copied into new packs first.
+    live = set()
+    for snapshot in repo.snapshots():
+        for db in repo.manifests(snapshot):
+            live.update(repo.iter_manifest(snapshot, db))
+
+    digests = set()
+    freed = 0
+    for name in repo.pack_names():
+        if repo.pack is not None and name == repo.pack['name']:
+            continue
+        size = os.path.getsize(os.path.join(repo.packs_path, name + '.pack'))
+        # a document stored twice is only live in the copy the repository reads
+        records = [record for record in repo.read_pack_index(name)
+                   if record[0] in live and repo.lookup(record[0]) == (name, record[1], record[2])]
+        live_bytes = sum(record[2] for record in records)
+        if len(records) > 0 and live_bytes >= size * REWRITE_BELOW:
+            for record in records:
+                digests.update(record[3])
+            continue
+
+        for i in range(0, len(records), 1000):
+            moved = [(record[0], repo.read_at(name, record[1], record[2]), record[3]) for record in records[i:i + 1000]]
+            for record in records[i:i + 1000]:
+                digests.update(record[3])
+            repo.append(moved, repo.stamp + '-gc')
+        # the copies are on disk before the original goes, and the key index
+        # is rebuilt without it when the repository is next opened
+        if name in repo.readers:
+            repo.readers.pop(name).close()
+        os.remove(os.path.join(repo.packs_path, name + '.idx'))
+        os.remove(os.path.join(repo.packs_path, name + '.keys'))
+        os.remove(os.path.join(repo.packs_path, name + '.pack'))
+        freed += size - live_bytes
+        print 'Pack {0}:  {1} of {2} bytes still referenced, {3}.'.format(name, live_bytes, size, 'rewritten' if len(records) > 0 else 'deleted')
+    repo.close()
+
+    removed = 0
+    attachments = os.path.join(repo.path, '.attachments')
+    if os.path.isdir(attachments):
+        live_names = set(backup_common.attachment_name(digest) for digest in digests)
+        for directory in os.listdir(attachments):
+            for f in os.listdir(os.path.join(attachments, directory)):
+                if f not in live_names:
+                    os.remove(os.path.join(attachments, directory, f))
+                    removed += 1
+    print 'Freed {0:.1f} MB of packs and {1} attachment files.'.format(freed / 1048576.0, removed)
+
+
+def main(argv):
+    parse_args(argv)
+    init_config()
+    repo = Repository(config['repopath'])
+
+    if config['list']:
+        list_snapshots(repo)
+    if config['snapshot'] is not None:
+        materialize(repo, config['snapshot'], config['outputpath'])
+    if config['keep'] > 0 or len(config['drop']) > 0:
+        drop_snapshots(repo, config['keep'], config['drop'])
+        collect(repo)
+    repo.close()
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
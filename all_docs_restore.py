@@ -2,15 +2,53 @@ import os
 import sys
 import getopt
 import getpass
-import base64
 import json
 import time
+import re
 import requests
-import fileinput
+import io
+import zlib
+import urllib
+import collections
 import multiprocessing.dummy as multiprocessing
+from multiprocessing import Pool as ProcessPool
 
+import all_docs_lookup
+import backup_common
+import request_throttle
 from pprint import pprint
 
+# guards the progress counters shared by the sender threads
+stats_lock = multiprocessing.Lock()
+# guards appends to the rejects file
+rejects_lock = multiprocessing.Lock()
+
+# acknowledged byte offset of every backup file (or range of one), see record_offset()
+journal = {}
+journal_lock = multiprocessing.Lock()
+# when the journal file was last written, and the offsets recorded since
+journal_written = 0.0
+journal_pending = 0
+
+# design docs held back per database until all of its data is in, see release_design_docs()
+design_docs = {}
+design_lock = multiprocessing.Lock()
+# bounds the number of view builds waited on at once, set up in main()
+view_slots = None
+# threads warming views, joined at the end of main() so no upload waits on them
+warmers = []
+# worker processes for parsing and compression with -P, set up in main()
+process_pool = None
+
+# per document _bulk_docs errors worth sending again; anything else is rejected
+retryable_errors = ['internal_server_error', 'unknown_error', 'timeout', 'too_many_requests', 'service_unavailable']
+
+# The start of an _all_docs row as CouchDB lays it out (id, key, value, then
+# doc last), and the _id leading a doc as all_docs_backup.py writes NDJSON.
+# Matching lines are sliced apart without being parsed, see split_line().
+row_prefix = re.compile(r'\{\s*"id"\s*:\s*("(?:[^"\\]|\\.)*")\s*,\s*"key"\s*:\s*"(?:[^"\\]|\\.)*"\s*,\s*"value"\s*:\s*\{\s*"rev"\s*:\s*"([^"\\]*)"\s*\}\s*,\s*"doc"\s*:\s*(?=\{)')
+doc_prefix = re.compile(r'\{\s*"_id"\s*:\s*("(?:[^"\\]|\\.)*")(?:\s*,\s*"_rev"\s*:\s*"([^"\\]*)")?')
+
 # configuration values
 config = dict(
     accountname = '',
@@ -21,21 +59,86 @@ config = dict(
     blocksize = 500,
     authheader = '',
     num_threads = 20,
-    restore = False
+    restore = False,
+    # only restore the docs whose _id falls in [startkey, endkey) and/or starts with prefix
+    startkey = None,
+    endkey = None,
+    prefix = None,
+    # number of line aligned byte ranges to restore a single file with in parallel
+    split = 1,
+    # number of _bulk_docs requests kept in flight per database
+    senders = 1,
+    # target bytes per _bulk_docs request, tuned as the restore runs; 0 batches by blocksize
+    batch_bytes = 0,
+    # bounds and step for the tuned batch size, and the response time it aims to stay under
+    min_batch_bytes = 65536,
+    max_batch_bytes = 8388608,
+    batch_bytes_step = 262144,
+    batch_latency = 5,
+    # process wide request and byte rates, see request_throttle.py; 0 is unlimited
+    rate_limit = 0,
+    byte_limit = 0,
+    # docs the server refused for good are written here, one JSON object per line
+    rejectspath = 'restore_rejects_{0}.ndjson'.format(int(time.time())),
+    # times a doc that failed with a retryable error is sent again
+    doc_retries = 5,
+    # parse every doc taken by the fast path in split_line() and check it against its _id
+    validate = False,
+    # ask _revs_diff which revisions the target lacks before posting a batch; it costs a round
+    # trip per batch, so it is off unless asked for, and on for --resume, which may replay a batch
+    dedup = False,
+    # only written with --resume or --journal; by default hidden in the input directory so it is
+    # never restored as a database.  None once it can't be written.
+    journalpath = None,
+    # the journal file is rewritten at most this often, or after this many offsets, and when a file completes
+    journal_interval = 1.0,
+    journal_batches = 100,
+    # pick every file up from its journalled offset, and keep its database even with -r
+    resume = False,
+    # write design docs only after the rest of their database, so bulk loading doesn't build views
+    defer_design = False,
+    # after the deferred design docs are written, build their views this many at a time; 0 skips it
+    warm_views = 0,
+    # gzip level for _bulk_docs request bodies, 1 (fastest) to 9 (smallest); 0 sends them as is
+    gzip_level = 0,
+    # worker processes that parse backup lines and gzip request bodies; 0 does it all on threads
+    processes = 0,
+    # bytes of backup lines handed to the parser at a time
+    chunk_bytes = 1048576,
+    # attachment bodies saved by all_docs_backup.py -A; defaults to .attachments in the input directory
+    attachmentspath = None,
     )
-usage = 'python ' + os.path.basename(__file__) + ' -p <path to json file or dir> -a <accountname> [-u <username>] [-b <# of records/update] [-r]'
+usage = 'python ' + os.path.basename(__file__) + ' -p <path to json file or dir> -a <accountname> [-u <username>] [-b <# of records/update] [-r] [--startkey=<id>] [--endkey=<id>] [--prefix=<id prefix>] [-s <# of ranges>] [-n <# of senders>] [-B <bytes/update>] [--ratelimit=<requests/sec>] [--bytelimit=<bytes/sec>] [--rejects=<rejects file>] [--validate] [--dedup] [--resume] [--journal=<journal file>] [--deferdesign] [--warmviews=<# of concurrent view builds>] [-z <gzip level>] [-P <# of processes>] [--attachments=<attachments dir>]'
 
 
 def parse_args(argv):
     # parse through the argument list and update the config dict as appropriate
     try:
-        opts, args = getopt.getopt(argv, "hp:b:u:a:r", 
+        opts, args = getopt.getopt(argv, "hp:b:u:a:rs:n:B:z:P:", 
                                    ["help",
                                     "path=",
                                     "blocksize=",
                                     "username=",
                                     "accountname=",
-                                    "restore"
+                                    "restore",
+                                    "startkey=",
+                                    "endkey=",
+                                    "prefix=",
+                                    "split=",
+                                    "senders=",
+                                    "batchbytes=",
+                                    "ratelimit=",
+                                    "bytelimit=",
+                                    "rejects=",
+                                    "validate",
+                                    "dedup",
+                                    "resume",
+                                    "journal=",
+                                    "deferdesign",
+                                    "warmviews=",
+                                    "gzip=",
+                                    "processes=",
+                                    "attachments="
                                     ])
     except getopt.GetoptError:
         print usage
@@ -54,6 +157,44 @@ def parse_args(argv):
             config['accountname'] = arg
         elif opt in ("-r", "restore"):
             config['restore'] = True
+        elif opt == "--startkey":
+            config['startkey'] = arg
+        elif opt == "--endkey":
+            config['endkey'] = arg
+        elif opt == "--prefix":
+            config['prefix'] = arg
+        elif opt in ("-s", "--split"):
+            config['split'] = int(arg)
+        elif opt in ("-n", "--senders"):
+            config['senders'] = int(arg)
+        elif opt in ("-B", "--batchbytes"):
+            config['batch_bytes'] = int(arg)
+        elif opt == "--ratelimit":
+            config['rate_limit'] = float(arg)
+        elif opt == "--bytelimit":
+            config['byte_limit'] = int(arg)
+        elif opt == "--rejects":
+            config['rejectspath'] = arg
+        elif opt == "--validate":
+            config['validate'] = True
+        elif opt == "--dedup":
+            config['dedup'] = True
+        elif opt == "--resume":
+            config['resume'] = True
+            config['dedup'] = True
+        elif opt == "--journal":
+            config['journalpath'] = arg
+        elif opt == "--deferdesign":
+            config['defer_design'] = True
+        elif opt == "--warmviews":
+            config['defer_design'] = True
+            config['warm_views'] = int(arg)
+        elif opt in ("-z", "--gzip"):
+            config['gzip_level'] = int(arg)
+        elif opt in ("-P", "--processes"):
+            config['processes'] = int(arg)
+        elif opt == "--attachments":
+            config['attachmentspath'] = arg
  
 
 def init_config():
@@ -68,6 +209,13 @@ def init_config():
     
     config['baseurl'] = 'https://{0}.cloudant.com/'.format(config['accountname'])
 
+    # resolved before the chdir below so the rejects never land among the files being restored
+    config['rejectspath'] = os.path.abspath(config['rejectspath'])
+    if config['journalpath'] is not None:
+        config['journalpath'] = os.path.abspath(config['journalpath'])
+    if config['attachmentspath'] is not None:
+        config['attachmentspath'] = os.path.abspath(config['attachmentspath'])
+
     # lets change the working directory to make things easier later on
     if os.path.isfile(config['inputpath']):
         last_index_of_slash = config['inputpath'].rfind('/')
@@ -76,6 +224,10 @@ def init_config():
             config['inputpath'] = config['inputpath'][last_index_of_slash+1:]
     else:
         os.chdir(config['inputpath'])
+    if config['attachmentspath'] is None:
+        config['attachmentspath'] = os.path.abspath('.attachments')
+    if config['journalpath'] is None and config['resume']:
+        config['journalpath'] = os.path.abspath('.restore_journal')
 
 def get_password():
     config['password'] = getpass.getpass('Password for {0}:'.format(config["username"]))
@@ -102,14 +254,14 @@ def initialize_db(dbname, session, retries=5):
             if r.status_code != 201:
                 print 'The database "{0}" was not created!  Retrying.'.format(dbname)
                 print json.dumps(r.json(), indent=4)
-                time.sleep(5)
+                request_throttle.backoff()
                 initialize_db(dbname, session, retries)
         else:
             print 'initialize_db:  Error! Retries exceeded.  Failed to create database "{0}".'.format(dbname)
             return
     except:
         print 'initialize_db:  Warning!  Database creation failed.  Retrying.'
-        time.sleep(5)
+        request_throttle.backoff()
         initialize_db(dbname, session, retries)
 
 
@@ -121,95 +273,852 @@ def delete_db(dbname, session, retries=5):
             if r.status_code != 200:
                 print 'Failed to delete database "{0}"! Retrying'.format(dbname)
                 print json.dumps(r.json(), indent=4)
-                time.sleep(5)
+                request_throttle.backoff()
                 delete_db(dbname, session, retries)
         else:
             print 'delete_db:  Error! Retries exceeded.  Failed to delete database "{0}".'.format(dbname)
             return
     except:
         print 'delete_db:  Warning!  Database deletion failed.  Retrying.'
-        time.sleep(5)
+        request_throttle.backoff()
         delete_db(dbname, session, retries)
 
 
-def updatedb(dbname, requestdata, session, retries=5):
+def bulk_body(docs):
+    # the docs are already JSON, so the request body is put together as text
+    return '{"new_edits":false,"docs":[' + ','.join(raw for doc_id, rev, raw in docs) + ']}'
+
+
+def gzip_body(data):
+    # zlib gives up the GIL while it deflates, so every sender compresses in parallel
+    compressor = zlib.compressobj(config['gzip_level'], zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+
+def updatedb(dbname, docs, session, retries=5, sizer=None, stats=None):
     retries -= 1
     try:
         if retries >= 0:
-            headers = config['authheader']
+            headers = dict(config['authheader'])
             headers.update({'Content-type': 'application/json'})
+            data = bulk_body(docs)
+            if stats is not None:
+                with stats_lock:
+                    stats['json_bytes'] += len(data)
+            if config['gzip_level'] > 0:
+                if process_pool is not None:
+                    data = process_pool.apply(gzip_body, (data,))
+                else:
+                    data = gzip_body(data)
+                headers.update({'Content-Encoding': 'gzip'})
+            if stats is not None:
+                with stats_lock:
+                    stats['sent_bytes'] += len(data)
+            start = time.time()
             r = session.post(
                 '{0}{1}/_bulk_docs'.format(config['baseurl'], dbname),
                 headers = headers,
-                data = json.dumps(requestdata)
+                data = data
                 )
+            if sizer is not None:
+                # a 429 absorbed by the throttled session still counts against the batch size
+                sizer.observe(429 if getattr(r, 'throttled', 0) else r.status_code, time.time() - start, len(data))
+
+            if r.status_code == 413 and len(docs) > 1:
+                # too large for the server, so send it as two halves instead
+                half = len(docs) / 2
+                first = updatedb(dbname, docs[:half], session, 5, sizer, stats)
+                second = updatedb(dbname, docs[half:], session, 5, sizer, stats)
+                if first is None or second is None:
+                    return None
+                return first + second
+
             if r.status_code != 201 and r.status_code != 202:
                 print 'Failed to post bulk update for database "{0}"!  Retrying.'.format(dbname)
                 print json.dumps(r.json(), indent=4)
-                time.sleep(5)
-                updatedb(dbname, requestdata, session, retries)
+                request_throttle.backoff()
+                return updatedb(dbname, docs, session, retries, sizer, stats)
 
-            if len(r.json()) > 0:
-                print json.dumps(r.json(), indent=4)
+            # with new_edits=false only the docs that failed are listed
+            return [row for row in r.json() if 'error' in row]
         else:
             print 'updatedb:  Error! Retries exceeded.  Failed to update database "{0}".'.format(dbname)
-            return
+            return None
     except:
         print 'updatedb:  Warning!  Bulk update failed.  Retrying.'
-        time.sleep(5)
-        updatedb(dbname, requestdata, session, retries)
+        if sizer is not None:
+            sizer.observe(None, 0, 0)
+        request_throttle.backoff()
+        return updatedb(dbname, docs, session, retries, sizer, stats)
+
+
+class BatchSizer(object):
+    # AIMD control of the _bulk_docs request size for one database.  Quick
+    # responses grow the byte budget by a fixed step, while 413s, 429s,
+    # timeouts, failed requests or slow responses halve it.
+
+    def __init__(self, dbname):
+        self.dbname = dbname
+        self.target = config['batch_bytes']
+        self.lock = multiprocessing.Lock()
+        self.batches = 0
+        self.total_bytes = 0
+
+    def full(self, batchbytes, batchdocs):
+        if self.target <= 0:
+            return batchdocs >= config['blocksize']
+        return batchbytes >= self.target
+
+    def observe(self, status, seconds, requestbytes):
+        if self.target <= 0:
+            return
+        with self.lock:
+            if status in (None, 408, 413, 429, 503, 504) or seconds > config['batch_latency']:
+                target = max(config['min_batch_bytes'], self.target / 2)
+                if target != self.target:
+                    print 'Database "{0}":  {1} after {2:.1f}s, batch size lowered to {3} KB.'.format(
+                        self.dbname, status if status is not None else 'Request failure', seconds, target / 1024)
+                self.target = target
+            else:
+                self.target = min(config['max_batch_bytes'], self.target + config['batch_bytes_step'])
+            if status in (201, 202):
+                self.batches += 1
+                self.total_bytes += requestbytes
+
+    def report(self):
+        if self.target > 0 and self.batches > 0:
+            print 'Database "{0}":  {1} batches averaging {2} KB, batch size settled at {3} KB.'.format(
+                self.dbname, self.batches, self.total_bytes / self.batches / 1024, self.target / 1024)
+
+
+def iter_docs(filename, start=0, end=None, stats=None):
+    if config['startkey'] is not None or config['endkey'] is not None or config['prefix'] is not None:
+        return iter_selected_docs(filename, start, end, stats)
+    return iter_all_docs(filename, start, end, stats)
+
+
+def iter_selected_docs(filename, start=0, end=None, stats=None):
+    # with an index from all_docs_lookup.py only the selected docs are read,
+    # otherwise the file (or byte range) is scanned and filtered
+    if start == 0 and end is None and all_docs_lookup.has_index(filename):
+        index = all_docs_lookup.BackupIndex(filename)
+        ndjson = '.ndjson' in filename
+        for offset, length in index.iter_spans(config['startkey'], config['endkey'], config['prefix']):
+            found = split_line(index.read_span(offset, length), ndjson)
+            if found is not None:
+                # read in _id order, so there is no file offset to journal
+                yield found + (None,)
+        index.close()
+    else:
+        for doc_id, rev, raw, pos in iter_all_docs(filename, start, end, stats):
+            if all_docs_lookup.id_in_range(doc_id, config['startkey'], config['endkey'], config['prefix']):
+                yield doc_id, rev, raw, pos
+
+
+def seek_forward(f, offset):
+    # compressed streams may not seek, but can always be read up to the offset
+    try:
+        f.seek(offset)
+    except (IOError, ValueError, io.UnsupportedOperation):
+        remaining = offset - f.tell()
+        while remaining > 0:
+            chunk = f.read(min(remaining, 1048576))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+
+
+def iter_lines(f, start=0, end=None):
+    # Yields each line with the offset just past it.  A line belongs to the
+    # byte range it starts in.  Unless the range starts the file, the partial
+    # line in front of it is left to the previous range.
+    pos = 0
+    if start > 0:
+        seek_forward(f, start - 1)
+        pos = start - 1 + len(f.readline())
+    while end is None or pos < end:
+        line = f.readline()
+        if not line:
+            break
+        pos += len(line)
+        yield line, pos
+
+
+def valid_doc(doc_id, raw):
+    try:
+        doc = json.loads(raw)
+    except ValueError:
+        return False
+    return isinstance(doc, dict) and doc.get('_id') == doc_id
+
+
+def split_line(text, ndjson):
+    # Returns (_id, _rev, doc as JSON text) for one line of a backup, or None
+    # when the line holds no doc.  Rows laid out the usual way are sliced apart
+    # and only their _id string is decoded; anything else goes through json.
+    m = (doc_prefix if ndjson else row_prefix).match(text)
+    if m is not None:
+        raw = text if ndjson else text[m.end():-1].rstrip()
+        if raw.endswith('}') and text.endswith('}'):
+            doc_id = json.loads(m.group(1))
+            if not config['validate'] or valid_doc(doc_id, raw):
+                return doc_id, m.group(2), raw
+            print 'Document "{0}" failed validation, parsing its line in full.'.format(doc_id)
+
+    row = json.loads(text)
+    if ndjson:
+        return row['_id'], row.get('_rev'), text
+    if row.get('doc') is None:
+        return None
+    return row['doc']['_id'], row['doc'].get('_rev'), json.dumps(row['doc'], separators=(',', ':'))
+
+
+def parse_lines(filename, lines, rowcounter, start):
+    # Turns (line, offset) pairs into (_id, _rev, doc JSON, offset) tuples and
+    # counts the lines that could not be parsed.  With -P this runs in a worker
+    # process, so it only touches what it is given and the config it forked with.
+    ndjson = '.ndjson' in filename
+    docs = []
+    bad_lines = 0
+    for line, pos in lines:
+        text = line.rstrip()
+        if not ndjson and text.endswith(','):
+            text = text[:-1]
+        try:
+            found = split_line(text, ndjson)
+        except (ValueError, KeyError, TypeError, AttributeError):
+            if ndjson:
+                print 'Unable to parse line {0} of "{1}"!'.format(rowcounter, filename)
+                bad_lines += 1
+            elif (rowcounter != 0 or start > 0) and text != ']}':
+                # the _all_docs header and trailer are expected to fail
+                print 'An exception occured on line {0}'.format(rowcounter)
+                bad_lines += 1
+        else:
+            if found is not None:
+                docs.append(found + (pos,))
+        rowcounter += 1
+    return docs, bad_lines
 
 
-def upload(filename, dbname, session):
-    blockcounter = 0
+def iter_chunks(filename, start=0, end=None):
+    f = backup_common.open_backup(filename)
+    chunk = []
+    chunkbytes = 0
     rowcounter = 0
-    requestdata = dict(new_edits=False,docs=[])
-    for line in fileinput.FileInput(filename):
+    for line, pos in iter_lines(f, start, end):
+        chunk.append((line, pos))
+        chunkbytes += len(line)
+        if chunkbytes >= config['chunk_bytes']:
+            yield filename, chunk, rowcounter, start
+            rowcounter += len(chunk)
+            chunk = []
+            chunkbytes = 0
+    if len(chunk) > 0:
+        yield filename, chunk, rowcounter, start
+    f.close()
+
+
+def parsed_chunks(filename, start=0, end=None):
+    # Yields the parse_lines() result of every chunk in file order.  With -P
+    # the chunks are parsed by the worker processes, at most two per worker
+    # in flight.
+    if process_pool is None:
+        for chunk in iter_chunks(filename, start, end):
+            yield parse_lines(*chunk)
+        return
+    pending = collections.deque()
+    for chunk in iter_chunks(filename, start, end):
+        pending.append(process_pool.apply_async(parse_lines, chunk))
+        if len(pending) >= config['processes'] * 2:
+            yield pending.popleft().get()
+    while len(pending) > 0:
+        yield pending.popleft().get()
+
+
+def iter_all_docs(filename, start=0, end=None, stats=None):
+    for docs, bad_lines in parsed_chunks(filename, start, end):
+        if stats is not None:
+            stats['bad_lines'] += bad_lines
+        for doc in docs:
+            yield doc
+
+
+def read_journal():
+    if not os.path.exists(config['journalpath']):
+        return {}
+    try:
+        with open(config['journalpath'], 'r') as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        print 'read_journal:  Warning!  Unable to read "{0}": {1}  Restoring every file from the start.'.format(config['journalpath'], sys.exc_info()[1])
+        return {}
+
+
+def write_journal():
+    # caller holds journal_lock.  A journal that can't be written, say on a
+    # read only backup mount, is given up on rather than failing the restore.
+    global journal_written, journal_pending
+    if config['journalpath'] is None:
+        return
+    try:
+        with open(config['journalpath'] + '.tmp', 'w') as f:
+            f.write(json.dumps(journal))
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(config['journalpath'] + '.tmp', config['journalpath'])
+    except (IOError, OSError):
+        print 'write_journal:  Warning!  Unable to write "{0}": {1}  Continuing without a journal.'.format(config['journalpath'], sys.exc_info()[1])
+        config['journalpath'] = None
+    journal_written = time.time()
+    journal_pending = 0
+
+
+def journal_key(filename, start):
+    return '{0}@{1}'.format(filename, start)
+
+
+def record_offset(key, offset, complete=False, design=None):
+    # Offsets are written out in bulk rather than per batch.  A crash loses
+    # at most the last interval's worth, which a resume sends again.  With
+    # --deferdesign the design docs held back from before the offset are
+    # kept alongside it, since the file will not be read there again.
+    global journal_pending
+    with journal_lock:
+        journal[key] = dict(offset=offset, complete=complete)
+        if design is not None:
+            journal[key]['design'] = design
+        journal_pending += 1
+        if complete or journal_pending >= config['journal_batches'] or time.time() - journal_written >= config['journal_interval']:
+            write_journal()
+
+
+def flush_journal():
+    with journal_lock:
+        if journal_pending > 0:
+            write_journal()
+
+
+def journalled(filename):
+    # whether an earlier run got anywhere with this file
+    return any(key.rsplit('@', 1)[0] == filename for key in journal)
+
+
+def journalled_design(key):
+    # the held design docs an earlier run got past, as split_line() gives them
+    return [(doc_id, rev, raw.encode('utf-8')) for doc_id, rev, raw in journal[key].get('design', [])]
+
+
+class RestoreProgress(object):
+    # Batches are acknowledged out of order by the senders.  Only the offset
+    # up to which every batch has been acknowledged goes to the journal,
+    # along with the design docs held back from before it.
+
+    def __init__(self, key, start, held=()):
+        self.key = key
+        self.offset = start
+        self.next = 0
+        self.acked = {}
+        # design docs held back, each with the offset just past its line
+        self.held = [(doc, start) for doc in held]
+        self.lock = multiprocessing.Lock()
+
+    def hold(self, doc, pos):
+        with self.lock:
+            self.held.append((doc, pos))
+
+    def held_docs(self):
+        with self.lock:
+            return [doc for doc, pos in self.held]
+
+    def ack(self, seq, end):
+        with self.lock:
+            self.acked[seq] = end
+            advanced = False
+            while self.next in self.acked:
+                end = self.acked.pop(self.next)
+                if end is not None:
+                    self.offset = end
+                self.next += 1
+                advanced = True
+            if advanced:
+                design = None
+                if config['defer_design']:
+                    # docs read out of file order have no offset, and are never past it
+                    design = [doc for doc, pos in self.held if pos is not None and pos <= self.offset]
+                record_offset(self.key, self.offset, design=design)
+            return self.next
+
+
+def new_stats():
+    return dict(docs=0, batches=0, failed_batches=0, bad_lines=0, retried_docs=0, rejected_docs=0, skipped_docs=0, json_bytes=0, sent_bytes=0, attachments=0)
+
+
+def write_rejects(dbname, rejects):
+    with rejects_lock:
+        with open(config['rejectspath'], 'ab') as f:
+            for (doc_id, rev, raw), error in rejects:
+                f.write(json.dumps(dict(db=dbname, id=doc_id, error=error.get('error'), reason=error.get('reason'), doc=json.loads(raw)), separators=(',', ':')) + '\n')
+
+
+def missing_revs(dbname, docs, session, retries=5):
+    # the _revs_diff response for the batch, or None if the target couldn't be asked
+    revs = {}
+    for doc_id, rev, raw in docs:
+        if rev is not None:
+            revs.setdefault(doc_id, []).append(rev)
+    retries -= 1
+    try:
+        if retries >= 0:
+            headers = dict(config['authheader'])
+            headers.update({'Content-type': 'application/json'})
+            r = session.post(
+                '{0}{1}/_revs_diff'.format(config['baseurl'], dbname),
+                headers = headers,
+                data = json.dumps(revs)
+                )
+            if r.status_code != 200:
+                print 'Failed to diff revisions for database "{0}"!  Retrying.'.format(dbname)
+                print json.dumps(r.json(), indent=4)
+                request_throttle.backoff()
+                return missing_revs(dbname, docs, session, retries)
+            return r.json()
+        else:
+            print 'missing_revs:  Error! Retries exceeded.  Posting the whole batch to "{0}".'.format(dbname)
+            return None
+    except:
+        print 'missing_revs:  Warning!  Revision diff failed.  Retrying.'
+        request_throttle.backoff()
+        return missing_revs(dbname, docs, session, retries)
+
+
+def skip_present(dbname, docs, session):
+    # drop the docs whose exact revision the target already holds
+    diff = missing_revs(dbname, docs, session)
+    if diff is None:
+        return docs
+    return [doc for doc in docs if doc[1] is None or doc[1] in diff.get(doc[0], {}).get('missing', [])]
+
+
+def stubbed_doc(raw):
+    # the parsed doc if it only holds stubs for some of its attachments, else None
+    if '"_attachments"' not in raw:
+        return None
+    doc = json.loads(raw)
+    stubs = doc.get('_attachments') or {}
+    if any(stub.get('stub') for stub in stubs.values()):
+        return doc
+    return None
+
+
+class MultipartBody(object):
+    # A multipart/related request body: the doc as JSON, then each attachment
+    # body read from its file a block at a time as the request is sent.  The
+    # length is known up front, so it still goes out with a Content-Length.
+
+    def __init__(self, doc, paths, boundary):
+        self.parts = [('data', '--{0}\r\nContent-Type: application/json\r\n\r\n{1}'.format(boundary, json.dumps(doc, separators=(',', ':'))))]
+        for path in paths:
+            self.parts.append(('data', '\r\n--{0}\r\n\r\n'.format(boundary)))
+            self.parts.append(('file', path))
+        self.parts.append(('data', '\r\n--{0}--'.format(boundary)))
+        self.length = sum(os.path.getsize(value) if kind == 'file' else len(value) for kind, value in self.parts)
+        self.current = None
+        self.seek(0)
+
+    def __len__(self):
+        return self.length
+
+    def seek(self, offset):
+        # only ever rewound to the start, for a retry
+        if self.current is not None:
+            self.current.close()
+        self.index = 0
+        self.current = None
+
+    def read(self, size=-1):
+        if size < 0:
+            size = self.length
+        blocks = []
+        while size > 0 and self.index < len(self.parts):
+            if self.current is None:
+                kind, value = self.parts[self.index]
+                self.current = open(value, 'rb') if kind == 'file' else io.BytesIO(value)
+            block = self.current.read(size)
+            if block == '':
+                self.current.close()
+                self.current = None
+                self.index += 1
+                continue
+            blocks.append(block)
+            size -= len(block)
+        return ''.join(blocks)
+
+
+def multipart_doc(doc):
+    # Swaps every stub for a "follows" entry and returns the doc with the
+    # attachment files in the order their bodies have to follow it.  The
+    # bodies are sent decoded, so only what holds for that is kept.
+    stubs = doc['_attachments']
+    attachments = collections.OrderedDict()
+    paths = []
+    for name in sorted(stubs):
+        stub = stubs[name]
+        if not stub.get('stub'):
+            attachments[name] = stub
+            continue
+        attachments[name] = dict(content_type=stub.get('content_type'), revpos=stub.get('revpos'), length=stub.get('length'), follows=True)
+        paths.append(backup_common.attachment_path(config['attachmentspath'], stub['digest']))
+    doc = dict(doc)
+    doc['_attachments'] = attachments
+    return doc, paths
+
+
+def put_attached(dbname, doc, paths, session, retries=5):
+    # Writes one doc along with its attachment bodies.  Returns None once it
+    # is in, or the error to reject it with.
+    retries -= 1
+    try:
+        if retries >= 0:
+            boundary = os.urandom(16).encode('hex')
+            headers = dict(config['authheader'])
+            headers.update({'Content-type': 'multipart/related; boundary="{0}"'.format(boundary)})
+            r = session.put(
+                '{0}{1}/{2}'.format(config['baseurl'], dbname, backup_common.doc_path(doc['_id'])),
+                headers = headers,
+                params = {'new_edits': 'false'},
+                data = MultipartBody(doc, paths, boundary)
+                )
+            if r.status_code == 201 or r.status_code == 202:
+                return None
+            error = r.json()
+            if r.status_code < 500 and error.get('error') not in retryable_errors:
+                return dict(id=doc['_id'], error=error.get('error'), reason=error.get('reason'))
+            print 'Failed to write "{0}" with its attachments to database "{1}"!  Retrying.'.format(doc['_id'], dbname)
+            print json.dumps(error, indent=4)
+            request_throttle.backoff()
+            return put_attached(dbname, doc, paths, session, retries)
+        else:
+            print 'put_attached:  Error! Retries exceeded.  Failed to write "{0}" to database "{1}".'.format(doc['_id'], dbname)
+            return dict(id=doc['_id'], error='retries_exceeded', reason='the doc and its attachments could not be written')
+    except:
+        print 'put_attached:  Warning!  Attachment upload failed.  Retrying.'
+        request_throttle.backoff()
+        return put_attached(dbname, doc, paths, session, retries)
+
+
+def restore_attached(dbname, docs, session, stats):
+    # Docs with attachment stubs can't go through _bulk_docs, so each is put
+    # on its own with the bodies saved at backup time.  Returns the docs left
+    # for _bulk_docs and the (doc, error) pairs of any that failed.
+    rest = []
+    rejects = []
+    for doc in docs:
+        parsed = stubbed_doc(doc[2])
+        if parsed is None:
+            rest.append(doc)
+            continue
+        parsed, paths = multipart_doc(parsed)
+        missing = [path for path in paths if not os.path.exists(path)]
+        if len(missing) > 0:
+            rejects.append((doc, dict(error='missing_attachment', reason='{0} was not saved with the backup'.format(missing[0]))))
+            continue
+        error = put_attached(dbname, parsed, paths, session)
+        if error is not None:
+            rejects.append((doc, error))
+            continue
+        with stats_lock:
+            stats['attachments'] += len(paths)
+    return rest, rejects
+
+
+def post_batch(dbname, batch, session, stats, sizer=None):
+    # Only the docs that came back with a retryable error are posted again.
+    # The rest of the failures are written to the rejects file.
+    docs = batch
+    # a database made afresh by -r holds nothing to skip, unless it was kept to be resumed
+    if config['dedup'] and (config['resume'] or not config['restore']):
+        docs = skip_present(dbname, docs, session)
+    skipped = len(batch) - len(docs)
+    docs, rejects = restore_attached(dbname, docs, session, stats)
+    failed_batch = False
+    retried = 0
+    for attempt in range(config['doc_retries'] + 1):
+        if len(docs) == 0:
+            break
+        errors = updatedb(dbname, docs, session, sizer=sizer, stats=stats)
+        if errors is None:
+            failed_batch = True
+            break
+        errors = dict((row.get('id'), row) for row in errors)
+        retry = []
+        for doc in docs:
+            error = errors.get(doc[0])
+            if error is None:
+                continue
+            if error['error'] in retryable_errors and attempt < config['doc_retries']:
+                retry.append(doc)
+            else:
+                rejects.append((doc, error))
+        if len(retry) == 0:
+            break
+        print 'Database "{0}":  {1} of {2} docs failed with retryable errors.  Retrying them.'.format(dbname, len(retry), len(docs))
+        retried += len(retry)
+        docs = retry
+        request_throttle.backoff()
+
+    if len(rejects) > 0:
+        print 'Database "{0}":  {1} docs rejected, see "{2}".'.format(dbname, len(rejects), config['rejectspath'])
+        write_rejects(dbname, rejects)
+    with stats_lock:
+        stats['batches'] += 1
+        stats['docs'] += len(batch)
+        stats['retried_docs'] += retried
+        stats['rejected_docs'] += len(rejects)
+        stats['skipped_docs'] += skipped
+        if failed_batch:
+            stats['failed_batches'] += 1
+    return not failed_batch
+
+
+def expect_design_docs(dbname):
+    # one call per upload of the database, made before any of them can finish
+    if config['defer_design']:
+        with design_lock:
+            held = design_docs.setdefault(dbname, dict(docs=[], uploads=0, keys=[]))
+            held['uploads'] += 1
+
+
+def release_design_docs(dbname, docs, session, stats, key):
+    # The last upload of a database to finish writes the design docs all of
+    # the uploads held back.  Only then are their journal entries complete.
+    with design_lock:
+        held = design_docs[dbname]
+        held['docs'].extend(docs)
+        if key is not None:
+            held['keys'].append(key)
+        held['uploads'] -= 1
+        if held['uploads'] > 0:
+            return
+        del design_docs[dbname]
+
+    ok = True
+    if len(held['docs']) > 0:
+        print 'Database "{0}":  data restored, writing {1} design docs.'.format(dbname, len(held['docs']))
+        ok = post_batch(dbname, held['docs'], session, stats)
+    if ok:
+        for key in held['keys']:
+            record_offset(key, journal[key]['offset'] if key in journal else 0, True)
+    if config['warm_views'] > 0:
+        warm_views(dbname, held['docs'])
+
+
+def warm_view(dbname, ddoc_id, view, session, retries=5, timeouts=60):
+    # Querying one view builds every view of the design doc.  While the
+    # server times out waiting on the build the query is repeated, pausing a
+    # little longer each time, up to timeouts times.  Failed queries are
+    # retried up to retries times.
+    url = '{0}{1}/{2}/_view/{3}'.format(config['baseurl'], dbname,
+        backup_common.doc_path(ddoc_id), urllib.quote(view.encode('utf-8'), ''))
+    waited = 0
+    while True:
         try:
-            line = line.rstrip()
-            if line[-1] == ',':
-                line = line[:-1]
-
-            bloated_doc = json.loads(line)
-
-            if blockcounter >= config['blocksize']:
-                #update db
-                updatedb(dbname, requestdata, session)
-                #reset the temp dict and counter
-                requestdata = dict(new_edits=False,docs=[])
-                blockcounter = 0
-
-            #add row to temp dict
-            requestdata['docs'].append(bloated_doc['doc'])
-            #increment the row counter
-            blockcounter += 1        
+            r = session.get(url, headers=config['authheader'], params={'limit': 0})
         except:
-            if rowcounter != 0 and line != ']}':
-                print 'An exception occured on line {0}'.format(rowcounter)
-        finally:
-            rowcounter += 1
-    fileinput.close()
-        
+            retries -= 1
+            if retries < 0:
+                print 'warm_view:  Error! Retries exceeded.  Leaving the views of "{0}" in database "{1}" to build on their own.'.format(ddoc_id, dbname)
+                return False
+            print 'warm_view:  Warning!  View query failed.  Retrying.'
+            request_throttle.backoff()
+            continue
+        if r.status_code == 200:
+            return True
+        if 'timeout' not in r.text:
+            print 'Unable to build the views of "{0}" in database "{1}"!'.format(ddoc_id, dbname)
+            print r.text
+            return False
+        waited += 1
+        if waited > timeouts:
+            print 'warm_view:  Warning!  The views of "{0}" in database "{1}" are still building.  Leaving them to the server.'.format(ddoc_id, dbname)
+            return False
+        time.sleep(min(request_throttle.MAX_BACKOFF, request_throttle.BASE_BACKOFF * 2 ** min(waited, 6)))
+
+
+def warm_design_doc(dbname, ddoc_id, view):
+    with view_slots:
+        start = time.time()
+        if warm_view(dbname, ddoc_id, view, request_throttle.Session()):
+            print 'Database "{0}":  views of "{1}" are warm after {2:.1f}s.'.format(dbname, ddoc_id, time.time() - start)
+
+
+def warm_views(dbname, docs):
+    # one thread per design doc, with view_slots bounding how many build at once across all databases
+    for doc_id, rev, raw in docs:
+        views = json.loads(raw).get('views') or {}
+        if len(views) == 0:
+            continue
+        t = multiprocessing.Process(target=warm_design_doc, args=(dbname, doc_id, sorted(views)[0]))
+        t.setDaemon(True)
+        with design_lock:
+            warmers.append(t)
+        t.start()
+
+
+def batch_sender(dbname, batches, session, stats, sizer, progress):
+    # The queue has to be drained whatever happens to a batch, or the reader
+    # blocks on it for good.  A batch that raises counts as failed and is
+    # never acknowledged, so the journal stays behind it.
+    while True:
+        item = batches.get()
+        if item is None:
+            break
+        seq, end, batch = item
+        try:
+            if post_batch(dbname, batch, session, stats, sizer):
+                progress.ack(seq, end)
+        except:
+            print 'batch_sender:  Error!  Batch {0} of database "{1}" failed: {2}'.format(seq, dbname, sys.exc_info()[1])
+            with stats_lock:
+                stats['failed_batches'] += 1
+
+
+def upload(filename, dbname, session, start=0, end=None, stats=None):
+    if stats is None:
+        stats = new_stats()
+    started = time.time()
+
+    key = journal_key(filename, start)
+    resumed = []
+    if config['resume'] and key in journal:
+        if journal[key]['complete']:
+            print 'Database "{0}":  "{1}" was already restored from byte {2}.  Skipping it.'.format(dbname, filename, start)
+            if config['defer_design']:
+                release_design_docs(dbname, [], session, stats, None)
+            return stats
+        print 'Database "{0}":  resuming "{1}" at byte {2}.'.format(dbname, filename, journal[key]['offset'])
+        start = journal[key]['offset']
+        resumed = journalled_design(key)
+    progress = RestoreProgress(key, start, resumed if config['defer_design'] else [])
+
+    # This thread only parses and batches.  The senders post the batches, and
+    # the queue between them is bounded so memory stays capped at a couple of
+    # batches per sender.
+    batches = multiprocessing.Queue(config['senders'] * 2)
+    sizer = BatchSizer(dbname)
+    senders = []
+    for i in range(config['senders']):
+        sender_session = session if i == 0 else request_throttle.Session()
+        t = multiprocessing.Process(target=batch_sender, args=(dbname, batches, sender_session, stats, sizer, progress))
+        t.setDaemon(True)
+        senders.append(t)
+        t.start()
+
+    seq = 0
+    batchbytes = 0
+    batchend = None
+    # design docs journalled by a run with --deferdesign are sent along with the data otherwise
+    batch = [] if config['defer_design'] else resumed
+    for doc_id, rev, raw, pos in iter_docs(filename, start, end, stats):
+        if config['defer_design'] and doc_id.startswith('_design/'):
+            progress.hold((doc_id, rev, raw), pos)
+            continue
+
+        if len(batch) > 0 and sizer.full(batchbytes, len(batch)):
+            #hand the batch to the senders, with the offset it ends at
+            batches.put((seq, batchend, batch))
+            seq += 1
+            #reset the batch and byte counter
+            batch = []
+            batchbytes = 0
+
+        #add the doc, still as JSON text, to the batch
+        batch.append((doc_id, rev, raw))
+        batchbytes += len(raw)
+        batchend = pos
+
     #write any remaining rows to the database
-    updatedb(dbname, requestdata, session)
+    if len(batch) > 0:
+        batches.put((seq, batchend, batch))
+        seq += 1
+
+    for t in senders:
+        batches.put(None)
+    for t in senders:
+        t.join()
+
+    # the rest of the file needs nothing more once every batch is in
+    if config['defer_design']:
+        release_design_docs(dbname, progress.held_docs(), session, stats, key if progress.next == seq else None)
+    elif progress.next == seq:
+        record_offset(key, progress.offset, True)
+
+    sizer.report()
+    print 'Database "{0}" uploading completed:  {1} docs, {2} already present, {3} retried, {4} rejected, {5} attachments.'.format(
+        dbname, stats['docs'], stats['skipped_docs'], stats['retried_docs'], stats['rejected_docs'], stats['attachments'])
+    report_throughput('Database "{0}"'.format(dbname), stats, time.time() - started)
+    return stats
 
-    print 'Database "{0}" uploading completed.'.format(dbname)
+
+def report_throughput(name, stats, seconds):
+    line = '{0}:  {1:.0f} docs/sec'.format(name, stats['docs'] / max(seconds, 0.001))
+    if config['gzip_level'] > 0 and stats['sent_bytes'] > 0:
+        line += ', {0} KB of JSON sent as {1} KB gzip ({2:.1f}x)'.format(
+            stats['json_bytes'] / 1024, stats['sent_bytes'] / 1024, float(stats['json_bytes']) / stats['sent_bytes'])
+    print line + '.'
+
+
+def prepare_db(dbname, session, filename):
+    if config['restore'] == True:
+        if config['resume'] and journalled(filename):
+            print 'Database "{0}" has a restore in progress, so it is being kept.'.format(dbname)
+            return
+        else:
+            delete_db(dbname, session)
+
+    initialize_db(dbname, session)
+
+
+def enqueue_ranges(queue, filename):
+    # Split one file into line aligned byte ranges against the same database.
+    # The database is prepared once up front rather than by every range.
+    dbname = filename.split('.')[0]
+    size = os.path.getsize(filename)
+    prepare_db(dbname, request_throttle.Session(), filename)
+
+    ranges = []
+    step = size / config['split'] + 1
+    for i in range(config['split']):
+        start = i * step
+        if start >= size:
+            break
+        task = dict(filename=filename, dbname=dbname, index=i, start=start, end=min(size, start + step), stats=new_stats())
+        expect_design_docs(dbname)
+        queue.put(task)
+        ranges.append(task)
+    return ranges
+
+
+def upload_range(task, session):
+    stats = upload(task['filename'], task['dbname'], session, task['start'], task['end'], task['stats'])
+    print 'Range {0} of "{1}" (bytes {2}-{3}):  {4} docs in {5} batches, {6} failed batches, {7} rejected docs, {8} unparseable lines.'.format(
+        task['index'], task['filename'], task['start'], task['end'], stats['docs'], stats['batches'], stats['failed_batches'], stats['rejected_docs'], stats['bad_lines'])
 
 
 def upload_dispatcher(queue):
-    s = requests.Session()
+    s = request_throttle.Session()
     while True:
         f = queue.get()
         if f is None:
             print 'End of restore list reached.  Thread exiting...'
             break
 
-        dbname = f.split('.')[0]
-
-        if config['restore'] == True:
-            delete_db(dbname, s)
+        if isinstance(f, dict):
+            upload_range(f, s)
+            continue
 
-        initialize_db(dbname, s)
+        dbname = f.split('.')[0]
+        prepare_db(dbname, s, f)
         upload(f, dbname, s)
 
 
@@ -218,17 +1127,38 @@ def main(argv):
     init_config()
     get_password()
     authenticate()
+    request_throttle.configure(config['rate_limit'], config['byte_limit'])
+    if config['resume']:
+        journal.update(read_journal())
+    global view_slots, process_pool
+    view_slots = multiprocessing.BoundedSemaphore(max(1, config['warm_views']))
+    if config['processes'] > 0:
+        # forked before any threads start, so the workers inherit a quiet copy of the config
+        process_pool = ProcessPool(config['processes'])
 
     q = multiprocessing.Queue()
+    ranges = []
     # if we're processing a directory which contains X number of json files
     if os.path.isfile(config['inputpath']):
-        q.put(config['inputpath'])
-        config['num_threads'] = 1
+        compressed = config['inputpath'].endswith('.gz') or config['inputpath'].endswith('.zst')
+        if config['split'] > 1 and not compressed:
+            ranges = enqueue_ranges(q, config['inputpath'])
+            config['num_threads'] = len(ranges)
+        else:
+            if config['split'] > 1:
+                print 'Compressed files cannot be split by byte range.  Restoring "{0}" with one thread.'.format(config['inputpath'])
+            expect_design_docs(config['inputpath'].split('.')[0])
+            q.put(config['inputpath'])
+            config['num_threads'] = 1
     else:
         for f in os.listdir('.'):
-            q.put(f)
+            # skip hidden bookkeeping files such as backup checkpoints, and the journal
+            if not f.startswith('.') and os.path.abspath(f) != config['journalpath']:
+                expect_design_docs(f.split('.')[0])
+                q.put(f)
 
     threads = []
+    started = time.time()
 
     for i in range(config['num_threads']):
         t = multiprocessing.Process(target=upload_dispatcher, args=(q,))
@@ -239,7 +1169,25 @@ def main(argv):
 
     for t in threads:
         t.join()
+    flush_journal()
+
+    if len(warmers) > 0:
+        print 'Waiting for the views of {0} design docs to build...'.format(len(warmers))
+        for t in warmers:
+            t.join()
+
+    if len(ranges) > 0:
+        totals = new_stats()
+        for task in ranges:
+            for key in totals:
+                totals[key] += task['stats'][key]
+        print '"{0}" restored from {1} ranges:  {2} docs in {3} batches, {4} failed batches, {5} already present, {6} retried docs, {7} rejected docs, {8} unparseable lines.'.format(
+            config['inputpath'], len(ranges), totals['docs'], totals['batches'], totals['failed_batches'], totals['skipped_docs'], totals['retried_docs'], totals['rejected_docs'], totals['bad_lines'])
+        report_throughput('"{0}"'.format(config['inputpath']), totals, time.time() - started)
 
+    if process_pool is not None:
+        process_pool.close()
+        process_pool.join()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,403 @@
+import base64
+import collections
+import gzip
+import heapq
+import io
+import json
+import math
+import multiprocessing.dummy as multiprocessing
+import os
+import re
+import sys
+import threading
+import urllib
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+import all_docs_lookup
+import request_throttle
+
+
+# Shared by all_docs_backup.py and all_docs_backup_changes.py, and for
+# reading backups back, by all_docs_restore.py and all_docs_compact.py.
+
+# file extension written for each output codec
+codec_suffixes = {'none': '', 'gzip': '.gz', 'zstd': '.zst'}
+
+
+class RowSplitter(object):
+    # Cuts the row objects out of a streamed _all_docs or _changes body as the
+    # bytes arrive, without relying on the server putting one row per line.
+    tokens = re.compile(r'["{}\[\]]')
+    string_end = re.compile(r'["\\]')
+
+    def __init__(self):
+        self.buf = ''
+        self.pos = 0
+        self.depth = 0
+        self.in_string = False
+        self.start = None
+
+    def feed(self, chunk):
+        buf = self.buf + chunk
+        pos = self.pos
+        rows = []
+        while True:
+            if self.in_string:
+                m = self.string_end.search(buf, pos)
+                if m is None:
+                    pos = len(buf)
+                    break
+                if m.group() == '\\':
+                    # wait for the escaped character if it is in the next chunk
+                    if m.end() >= len(buf):
+                        pos = m.start()
+                        break
+                    pos = m.end() + 1
+                    continue
+                self.in_string = False
+                pos = m.end()
+                continue
+
+            m = self.tokens.search(buf, pos)
+            if m is None:
+                pos = len(buf)
+                break
+            c = m.group()
+            pos = m.end()
+            if c == '"':
+                self.in_string = True
+            elif c == '{' or c == '[':
+                # rows are the objects directly inside the array of the response
+                if c == '{' and self.depth == 2:
+                    self.start = m.start()
+                self.depth += 1
+            else:
+                self.depth -= 1
+                if c == '}' and self.depth == 2:
+                    rows.append(buf[self.start:pos])
+                    self.start = None
+
+        # only keep the unfinished row, if there is one
+        if self.start is not None:
+            self.buf = buf[self.start:]
+            self.pos = pos - self.start
+            self.start = 0
+        else:
+            self.buf = buf[pos:]
+            self.pos = 0
+        return rows
+
+
+def format_doc(doc):
+    # canonical NDJSON: compact separators and exactly one document per line,
+    # led by _id and _rev so all_docs_restore.py can read the _id without parsing
+    ordered = collections.OrderedDict((key, doc[key]) for key in ('_id', '_rev') if key in doc)
+    ordered.update(doc)
+    return json.dumps(ordered, separators=(',', ':')) + '\n'
+
+
+def open_output(filename):
+    # compress on the fly so a database is never buffered whole in memory;
+    # the codec is taken from the file extension
+    if filename.endswith('.gz'):
+        return gzip.open(filename, 'wb', 6)
+    elif filename.endswith('.zst'):
+        return zstandard.ZstdCompressor(level=3).stream_writer(open(filename, 'wb'))
+    return open(filename, 'wb')
+
+
+def open_backup(filename):
+    # backups written with -c by the backup scripts are decompressed as they are read
+    if filename.endswith('.gz'):
+        return gzip.open(filename, 'rb')
+    elif filename.endswith('.zst'):
+        if zstandard is None:
+            print 'The zstandard module is required to read "{0}".  Try "pip install zstandard".'.format(filename)
+            sys.exit()
+        return io.BufferedReader(zstandard.ZstdDecompressor().stream_reader(open(filename, 'rb'), read_across_frames=True))
+    return open(filename, 'rb')
+
+
+def db_weight(info):
+    # bytes of live data, falling back to the size fields of older CouchDB releases
+    if info is None:
+        return 0
+    if 'sizes' in info:
+        return info['sizes'].get('active', 0)
+    return info.get('other', {}).get('data_size', info.get('disk_size', 0))
+
+
+def sample_boundaries(db_url, headers, doc_count, num_ranges, session):
+    # Pick evenly spaced _ids to use as the edges of the key ranges.  The
+    # server reads through every row it skips, so each sample skips on from
+    # the one before rather than from the start, and the whole lot costs a
+    # single pass over the keys.
+    boundaries = []
+    step = max(1, doc_count / num_ranges)
+    for i in range(1, num_ranges):
+        params = {'limit': 1, 'skip': step}
+        if len(boundaries) > 0:
+            params['startkey'] = json.dumps(boundaries[-1])
+        r = session.get('{0}/_all_docs'.format(db_url), headers=headers, params=params)
+        rows = r.json().get('rows', []) if r.status_code == 200 else []
+        if len(rows) == 0:
+            break
+        boundaries.append(rows[0]['key'])
+    return boundaries
+
+
+def schedule_tasks(tasks, num_threads, binpack):
+    # Hands the (task, weight) pairs out largest first.  Each task goes to
+    # the least loaded worker, which is both the bin packed assignment and
+    # the prediction for a shared largest-first queue.
+    tasks = sorted(tasks, key=lambda task: task[1], reverse=True)
+
+    if binpack:
+        queues = [multiprocessing.Queue() for i in range(num_threads)]
+    else:
+        queues = [multiprocessing.Queue()] * num_threads
+
+    predicted = [0] * num_threads
+    loads = [(0, i) for i in range(num_threads)]
+    for task, weight in tasks:
+        load, i = heapq.heappop(loads)
+        predicted[i] = load + weight
+        heapq.heappush(loads, (load + weight, i))
+        queues[i].put(task)
+
+    return queues, predicted
+
+
+class BackupPlanner(object):
+    # Sizes the databases of a backup run, splits the big ones into key
+    # range segments, and saves and stitches those segments.  The scripts
+    # pass in what they do differently: skip(db) is true of databases taken
+    # whole without being sized (deltas), saved(db, info) is called once a
+    # split database is stitched, and save_attachments(db, refs, session)
+    # fetches the bodies of the stubs seen when config['attachments'] is set.
+
+    def __init__(self, config, skip=None, saved=None, save_attachments=None):
+        self.config = config
+        self.skip = skip or (lambda db: False)
+        self.saved = saved or (lambda db, info: None)
+        self.save_attachments = save_attachments
+        # databases being backed up as key range segments, see plan_db()
+        self.split_dbs = {}
+        self.split_lock = multiprocessing.Lock()
+        # predicted size of every whole database task
+        self.db_weights = {}
+        self.thread_local = threading.local()
+
+    def output_filename(self, db):
+        return '{0}/{1}.{2}{3}'.format(self.config['outputpath'], db, self.config['format'], codec_suffixes[self.config['codec']])
+
+    def index_output(self, filename):
+        if self.config['index']:
+            all_docs_lookup.build_index(filename)
+
+    def attachment_refs(self):
+        # the list write_stream() collects stubs into, or None without -A
+        if self.save_attachments is not None and self.config.get('attachments'):
+            return []
+        return None
+
+    def write_stream(self, r, f, refs=None):
+        # Copy a streamed response to the output, converting it to NDJSON if
+        # requested.  The attachment stubs of its docs are collected in refs,
+        # if given, so the bodies can be fetched once the stream is done.
+        splitter = RowSplitter()
+        for chunk in r.iter_content(chunk_size=5000000):
+            if not chunk:
+                continue
+            if self.config['format'] == 'ndjson':
+                docs = [json.loads(row).get('doc') for row in splitter.feed(chunk)]
+                f.write(''.join(format_doc(doc) for doc in docs if doc is not None))
+            else:
+                # rows are only parsed when they might hold a stub
+                docs = []
+                if refs is not None:
+                    docs = [json.loads(row).get('doc') for row in splitter.feed(chunk) if '"_attachments"' in row]
+                f.write(chunk)
+            if refs is not None:
+                for doc in docs:
+                    refs.extend(attachment_refs(doc))
+
+    def get_db_info(self, db, session):
+        r = session.get('{0}{1}'.format(self.config['baseurl'], db), headers=self.config['authheader'])
+        if r.status_code != 200:
+            return None
+        return r.json()
+
+    def plan_db(self, db, session, info=None):
+        # Returns the (task, weight) pairs for a database.  Databases above the
+        # split threshold become several key range segments so that idle threads
+        # can share the work.  Everything else is a single task.
+        split = self.config['split_threshold'] > 0 and not self.skip(db)
+        if info is None and split:
+            info = self.get_db_info(db, session)
+        weight = db_weight(info)
+
+        if split and info is not None and info['doc_count'] > self.config['split_threshold']:
+            num_ranges = min(self.config['num_threads'], int(math.ceil(float(info['doc_count']) / self.config['split_threshold'])))
+            keys = [None] + sample_boundaries(self.config['baseurl'] + db, self.config['authheader'], info['doc_count'], num_ranges, session) + [None]
+            num_segments = len(keys) - 1
+            self.split_dbs[db] = dict(info=info, num_segments=num_segments, remaining=num_segments, failed=False)
+            print 'Splitting {0} ({1} docs) into {2} key ranges...'.format(db, info['doc_count'], num_segments)
+            return [(dict(db=db, index=i, startkey=keys[i], endkey=keys[i + 1], weight=weight / num_segments), weight / num_segments) for i in range(num_segments)]
+
+        self.db_weights[db] = weight
+        return [(db, weight)]
+
+    def thread_session(self):
+        if not hasattr(self.thread_local, 'session'):
+            self.thread_local.session = request_throttle.Session()
+        return self.thread_local.session
+
+    def fetch_db_plan(self, db):
+        info = None
+        if self.config['schedule'] != 'none' and not self.skip(db):
+            info = self.get_db_info(db, self.thread_session())
+        return self.plan_db(db, self.thread_session(), info)
+
+    def plan_dbs(self, dbs):
+        # Sizes and splits every database concurrently, and returns all of their
+        # (task, weight) pairs in the order the databases were listed.
+        if self.config['schedule'] != 'none' or self.config['split_threshold'] > 0:
+            print 'Sizing {0} databases...'.format(len(dbs))
+        pool = multiprocessing.Pool(self.config['num_threads'])
+        plans = pool.map(self.fetch_db_plan, dbs)
+        pool.close()
+        pool.join()
+        return [task for plan in plans for task in plan]
+
+    def schedule_dbs(self, dbs):
+        # size every database concurrently, then hand the tasks out largest first
+        return schedule_tasks(self.plan_dbs(dbs), self.config['num_threads'], self.config['schedule'] == 'binpack')
+
+    def segment_path(self, db, index):
+        return '{0}/.{1}.json.part{2}'.format(self.config['outputpath'], db, index)
+
+    def stitch_segments(self, db):
+        info = self.split_dbs[db]
+        paths = [self.segment_path(db, i) for i in range(info['num_segments'])]
+
+        if info['failed']:
+            print 'Failed to save {0}!  One or more key ranges could not be retrieved.'.format(db)
+        else:
+            with open_output(self.output_filename(db)) as f:
+                write_segments(f, paths, self.config['format'] == 'ndjson', info['info']['doc_count'])
+            self.index_output(self.output_filename(db))
+            self.saved(db, info['info'])
+            print 'Saved {0}...'.format(db)
+
+        for path in paths:
+            if os.path.exists(path):
+                os.remove(path)
+
+    def save_segment(self, task, session):
+        db = task['db']
+        params = {'include_docs': 'true'}
+        if task['startkey'] is not None:
+            params['startkey'] = json.dumps(task['startkey'])
+        if task['endkey'] is not None:
+            params['endkey'] = json.dumps(task['endkey'])
+            params['inclusive_end'] = 'false'
+
+        ok = False
+        refs = self.attachment_refs()
+        try:
+            r = session.get('{0}{1}/_all_docs'.format(self.config['baseurl'], db), headers=self.config['authheader'], params=params, stream=True)
+            if r.status_code == 200:
+                with open(self.segment_path(db, task['index']), 'wb') as f:
+                    self.write_stream(r, f, refs)
+                ok = refs is None or self.save_attachments(db, refs, session)
+            else:
+                print 'Failed to retrieve key range {0} of {1}!'.format(task['index'], db)
+        except:
+            print 'save_segment:  Warning!  Key range {0} of {1} failed.'.format(task['index'], db)
+
+        # whichever thread finishes the last range stitches the backup together
+        with self.split_lock:
+            info = self.split_dbs[db]
+            info['remaining'] -= 1
+            info['failed'] = info['failed'] or not ok
+            last = info['remaining'] == 0
+        if last:
+            self.stitch_segments(db)
+
+
+def record_load(load, task, db_weights, seconds):
+    # load is the worker's entry in worker_loads; segments carry their own weight
+    if isinstance(task, dict):
+        weight = task['weight']
+    else:
+        weight = db_weights.get(task, 0)
+    load['tasks'] += 1
+    load['weight'] += weight
+    load['seconds'] += seconds
+
+
+def print_load_report(worker_loads, predicted):
+    print '\nWorker load (predicted MB / actual MB / busy seconds / tasks):'
+    for i in range(len(predicted)):
+        load = worker_loads[i]
+        print '  worker {0:>3}: {1:>12.1f} / {2:>12.1f} / {3:>10.1f} / {4}'.format(
+            i, predicted[i] / 1048576.0, load['weight'] / 1048576.0, load['seconds'], load['tasks'])
+
+
+def iter_segment_rows(path):
+    # _all_docs responses put one row per line between the header and trailer
+    with open(path, 'rb') as f:
+        for line in f:
+            line = line.strip()
+            if line.endswith(','):
+                line = line[:-1]
+            if line == '' or line == ']}' or line.startswith('{"total_rows"'):
+                continue
+            yield line
+
+
+def write_segments(f, paths, ndjson, total_rows):
+    # joins the key range segments of a database, in key order, into one backup
+    if ndjson:
+        # the segments were converted as they were fetched
+        for path in paths:
+            for doc in iter_segment_rows(path):
+                f.write(doc + '\n')
+    else:
+        f.write('{{"total_rows":{0},"offset":0,"rows":['.format(total_rows))
+        first = True
+        for path in paths:
+            for row in iter_segment_rows(path):
+                f.write(('\n' if first else ',\n') + row)
+                first = False
+        f.write('\n]}\n')
+
+
+def attachment_refs(doc):
+    # (_id, _rev, name, stub) of every attachment the doc only holds a stub for
+    if doc is None:
+        return []
+    stubs = doc.get('_attachments') or {}
+    return [(doc['_id'], doc['_rev'], name, stubs[name]) for name in sorted(stubs) if stubs[name].get('stub')]
+
+
+def attachment_name(digest):
+    return base64.b64decode(digest.split('-', 1)[1]).encode('hex')
+
+
+def attachment_path(root, digest):
+    # Bodies are named after the digest in their stub, so an attachment
+    # shared by several docs or databases is fetched and stored only once.
+    name = attachment_name(digest)
+    return os.path.join(root, name[:2], name)
+
+
+def doc_path(doc_id):
+    # design doc ids keep their slash, any other id is escaped whole
+    if doc_id.startswith('_design/'):
+        return '_design/' + urllib.quote(doc_id[len('_design/'):].encode('utf-8'), '')
+    return urllib.quote(doc_id.encode('utf-8'), '')
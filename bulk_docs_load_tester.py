@@ -2,6 +2,7 @@ import json
 import requests
 import multiprocessing.dummy as multiprocessing
 import time
+import zlib
 
 # variables
 user = 'FILL ME IN'
@@ -12,6 +13,7 @@ bulk_url = '{0}{1}/_bulk_docs'.format(base_url, db)
 runs = [{'body_size': 1000, 'trials': 3}]
 num_threads = 10
 interval = 900 # in seconds
+gzip_level = 0 # 1-9 sends request bodies with Content-Encoding: gzip, 0 sends them as is
 # sample file of doc
 filename = '/FILL/ME/IN'
 # design doc if needed
@@ -21,9 +23,27 @@ output_file = '/FILL/ME/IN'
 doc = ''
 
 
+def gzip_body(data):
+	compressor = zlib.compressobj(gzip_level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+	return compressor.compress(data) + compressor.flush()
+
+
+def encode_body(payload):
+	# returns the request body and its headers, compressed if gzip_level is set
+	body = json.dumps(payload)
+	headers = {'content-type': 'application/json'}
+	if gzip_level > 0:
+		body = gzip_body(body)
+		headers['content-encoding'] = 'gzip'
+	return body, headers
+
+
 def execute(q, payload):
 	s = requests.Session()
 
+	# the payload never changes, so each thread encodes it once up front
+	body, headers = encode_body(payload)
+
 	# count the number of executions
 	count = 0
 
@@ -34,7 +54,7 @@ def execute(q, payload):
 		if time.time() > timeout:
 			break
 
-		s.post(bulk_url, data=json.dumps(payload), headers={'content-type': 'application/json'}, auth=(user, pwd), verify=False)
+		s.post(bulk_url, data=body, headers=headers, auth=(user, pwd), verify=False)
 		count += 1
 
 	# add an item to the queue indicating the number of requests sent
@@ -65,6 +85,10 @@ def main():
 			request_body = {'docs': []}
 			for i in range(body_size):
 				request_body['docs'].append(doc)
+			if gzip_level > 0:
+				json_size = len(json.dumps(request_body))
+				gzip_size = len(encode_body(request_body)[0])
+				print 'Request body is {0} bytes, {1} bytes gzipped at level {2} ({3:.1f}x)...'.format(json_size, gzip_size, gzip_level, float(json_size) / gzip_size)
 			time.sleep(1)
 
 			# delete the database if it exists and then recreate it
@@ -111,6 +135,7 @@ def main():
 			# compute metrics
 			requests_per_second = float(total_requests) / interval
 			docs_written = total_requests * body_size
+			print '{0:.0f} docs/sec...'.format(float(docs_written) / interval)
 
 			with open(output_file, 'a') as oh:
 				oh.write('\n{0},{1},{2},{3},{4}'.format(interval, num_threads, body_size, requests_per_second, docs_written))
@@ -10,12 +10,14 @@ import os
 import time
 import getopt
 import getpass
+from multiprocessing.dummy import Pool as ThreadPool
 from ExceptionsModule import ReplError
 from ExceptionsModule import FatalError
 from ExceptionsModule import FilterError
 import ReplicationModule as rm
 import FilteringModule as fm
 import MonitoringModule as mm
+import PlanningModule as pm
 
 logging.basicConfig(filename='replication.log',level=logging.DEBUG)
 start_time = time.strftime('%c')
@@ -39,6 +41,10 @@ config = dict(
 	worker_batch_size = 500,
 	http_connections = 20,
 	connection_timeout = 300000,
+	follow_changes = False,
+	preflight_threads = 16,
+	submit_batch = 1,
+	size_weighted = False,
 	source_url = '',
 	source_auth = '',
 	target_url = '',
@@ -47,6 +53,10 @@ config = dict(
 	mediator_auth = ''
 )
 
+# with -S, the weight, size and doc count of every source db, and the weight of every POSTed replication doc
+plan = {}
+repl_weights = {}
+
 usage =  'python ' + os.path.basename(__file__) + ' -s <source user> -t <target user> [options]\n\n'
 usage += '''\
 options:
@@ -69,6 +79,8 @@ options:
                        design docs)
 
    -i <#>          :   Create incremental replications based on a previous id.
+                       The checkpoints of the previous batch are read up
+                       front, -P at a time.
 
    -z              :   Use this flag to override the replication concurrency
                        limit.  Note this will impact performance and is not
@@ -104,18 +116,236 @@ options:
    -T <#>          :   Set the timeout for http connections in milliseconds.
                        (Default is 300000)
 
+   -P <#>          :   Set the number of threads used to check credentials and
+                       create the target databases before any replication is
+                       POSTed.  (Default is 16)
+
+   -B <#>          :   POST up to this many replication docs at a time with
+                       _bulk_docs, as many as there are free slots.  Use with
+                       -z, a high -c or -o to start thousands of replications
+                       quickly.  (Default is 1, one POST per replication)
+
+   -e              :   Follow the _changes feed of the _replicator db to start
+                       the next replication as soon as one completes.  Falls
+                       back to polling every -p seconds if the feed is lost.
+                       (Default is to poll)
+
+   -S              :   Read the size of every source db first.  The largest
+                       dbs are replicated first and take a share of the
+                       concurrency limit in line with their size (at most
+                       half of it).  Large dbs get up to 4x the -w workers
+                       and -C connections, dbs that fit in a single -b batch
+                       get 1 worker and 2 connections.  (Default is to
+                       replicate in order, one slot per db)
+
    -h              :   Display this help message.
 '''
 
 
-# Accepts:  1) An array of dbs to process,
-#           2) An output queue for message passing,
-#           3) A failure queue for message passing
+# Accepts:  1) The replicator monitor, or None to poll the view,
+#           2) The URL of the view counting running replications,
+#           3) The limit for concurrent replications
+# Returns:  True if more replications can be POSTed, False otherwise
+def below_limit(monitor, running_repl_url, limit):
+	if monitor is not None and monitor.alive:
+		return monitor.running() < limit
+	return mm.poll_replicator(running_repl_url, config['mediator_auth'], limit, weights=running_weights())
+
+
+
+# Accepts:  1) The replicator monitor, or None to poll the view,
+#           2) The limit for concurrent replications
 # Returns:  Void
-def repl_dispatcher(dbs, running_repl_url, batch_id):
-	db_index = 0
+def wait_for_slot(monitor, limit):
+	# the monitor returns as soon as a replication finishes
+	if monitor is not None and monitor.alive:
+		monitor.wait_below(limit, config['polling_delay'])
+	else:
+		time.sleep(config['polling_delay'])
+
+
+
+# Accepts:  1) The replicator monitor, or None to poll the view,
+#           2) The URL of the view counting running replications
+# Returns:  The number of slots of the concurrency limit that are free right now
+def free_slots(monitor, running_repl_url):
+	if monitor is not None and monitor.alive:
+		running = monitor.running()
+	else:
+		running = mm.count_replications(running_repl_url, config['mediator_auth'], weights=running_weights())
+	return config['concurrency_limit'] - running
+
+
+
+# Accepts:  Nothing
+# Returns:  The weights to count running replications by, or None to count one per replication
+def running_weights():
+	if config['size_weighted']:
+		return repl_weights
+	return None
+
+
+
+# Accepts:  The source db name
+# Returns:  The number of slots of the concurrency limit its replication takes
+def db_weight(source_db):
+	if source_db in plan:
+		return plan[source_db]['weight']
+	return 1
+
+
+
+# Accepts:  1) An array of (source db, target db) pairs to process,
+#           2) The index of the next pair to POST,
+#           3) The number of free slots
+# Returns:  How many of the next pairs fit in the free slots, up to the -B batch size
+def fitting_dbs(dbs, db_index, slots):
+	num = 0
+	while num < config['submit_batch'] and db_index + num < len(dbs):
+		slots -= db_weight(dbs[db_index + num][0])
+		if slots < 0:
+			break
+		num += 1
+	return num
+
+
+
+# Accepts:  1) The source db name,
+#           2) The target db name,
+#           3) Additional replication options,
+#           4) Unique id to use with this set of replications
+# Returns:  The prepared replication document
+def build_repl_doc(source_db, target_db, repl_options, batch_id):
+	if source_db in plan:
+		repl_options = pm.tune_options(repl_options, plan[source_db])
+
+	repl_source = config['source_url'] + source_db
+	repl_target = config['target_url'] + target_db
+	doc = rm.create_repl_doc(repl_source, config['source_auth'], repl_target, 
+		config['target_auth'], config['mediator'], repl_options, batch_id, config['incremental_id'])
+
+	# create a design document for filtering ddocs if desired
+	if config['skip_ddocs']:
+		ddoc = fm.create_filter_func(config['source_url'] + source_db, config['source_auth'])
+		doc.update({'filter': '{0}/{1}'.format(ddoc['name'], ddoc['func'])})
+
+	return doc
+
+
+
+# Accepts:  1) An array of (source db, target db) pairs to process,
+#           2) The index of the first pair in the full list of dbs,
+#           3) The length of the full list of dbs,
+#           4) Additional replication options,
+#           5) Unique id to use with this set of replications,
+#           6) The replicator monitor, or None to poll the view
+# Returns:  The number of failed replications and failed filter ddocs
+def post_repl_batch(pairs, first_index, num_dbs, repl_options, batch_id, monitor):
 	num_failed_repl = num_failed_ddocs = 0
+
+	# build the docs, counting any db whose doc can't be built as failed
+	docs = []
+	doc_weights = {}
+	# the place of each db in the whole run, for the progress messages
+	doc_numbers = {}
+	for i, (source_db, target_db) in enumerate(pairs):
+		try:
+			docs.append(build_repl_doc(source_db, target_db, repl_options, batch_id))
+			doc_weights[docs[-1]['_id']] = db_weight(source_db)
+			doc_numbers[docs[-1]['_id']] = first_index + i + 1
+		except ReplError as re:
+			logging.log(re.level, '{0}\n{1}'.format(re.msg, json.dumps(re.r, indent=4)))
+			num_failed_repl += 1
+		except FilterError as fe:
+			logging.log(fe.level, '{0}\n{1}'.format(fe.msg, json.dumps(fe.r, indent=4)))
+			num_failed_ddocs += 1
+
+	if len(docs) == 0:
+		return [num_failed_repl, num_failed_ddocs]
+
+	# post them all to the mediator in one request
+	try:
+		errors = rm.post_repl_docs(config['mediator_url'], docs, config['mediator_auth'])
+	except ReplError as re:
+		logging.log(re.level, '{0}\n{1}'.format(re.msg, json.dumps(re.r, indent=4)))
+		return [num_failed_repl + len(docs), num_failed_ddocs]
+
+	# a rejected doc counts as a failed replication, just as a failed POST does
+	failed_ids = set()
+	for re in errors:
+		logging.log(re.level, '{0}\n{1}'.format(re.msg, json.dumps(re.r, indent=4)))
+		failed_ids.add(re.r.get('id'))
+		num_failed_repl += 1
+
+	for doc in docs:
+		if doc['_id'] in failed_ids:
+			continue
+		repl_weights[doc['_id']] = doc_weights[doc['_id']]
+		if monitor is not None:
+			monitor.posted(doc['_id'], doc_weights[doc['_id']])
+		print '[INITIATED] [{0}/{1}] Replication for {2} has been POSTed...'.format(doc_numbers[doc['_id']], num_dbs, doc['source']['url'])
+
+	return [num_failed_repl, num_failed_ddocs]
+
+
+
+# Accepts:  1) A pair of source db and target db names
+# Returns:  The pair if the target db is ready, None otherwise
+def prepare_target(pair):
+	try:
+		rm.create_new_db(config['target_url'], pair[1], config['target_auth'], config['new_q'])
+		return pair
+	except ReplError as re:
+		logging.log(re.level, '{0}\n{1}'.format(re.msg, json.dumps(re.r, indent=4)))
+	except:
+		print 'Unexpected Error creating {0}!  View the log for details.'.format(pair[1])
+		logging.error('Unexpected error occured! Error: {0}'.format(sys.exc_info()))
+	return None
+
+
+
+# Accepts:  1) An array of dbs to process
+# Returns:  The (source db, target db) pairs that are ready to replicate, and
+#           the number of dbs that could not be prepared
+def preflight(dbs):
+	pool = ThreadPool(config['preflight_threads'])
+
+	# a bad password stops the run before anything is created
+	accounts = set([(config['source_url'], config['source_auth']),
+		(config['target_url'], config['target_auth']),
+		(config['mediator_url'], config['mediator_auth'])])
+	pool.map(lambda account: rm.check_auth(account[0], account[1]), accounts)
+
+	# make the target db names unique if required
 	db_date = int(time.time())
+	pairs = []
+	for db in dbs:
+		if config['rename_dbs']:
+			pairs.append((db, '{0}-{1}'.format(db, db_date)))
+		else:
+			pairs.append((db, db))
+
+	# create the target dbs with the new q value if desired.  Otherwise the
+	# replications create them with the cluster default.
+	ready = pairs
+	if not config['use_default_q']:
+		print 'Creating {0} target dbs with q={1}...'.format(len(pairs), config['new_q'])
+		ready = [pair for pair in pool.map(prepare_target, pairs) if pair is not None]
+	pool.close()
+	pool.join()
+
+	return ready, len(pairs) - len(ready)
+
+
+
+# Accepts:  1) An array of (source db, target db) pairs to process,
+#           2) The URL of the view counting running replications,
+#           3) Unique id to use with this set of replications,
+#           4) The replicator monitor, or None to poll the view
+# Returns:  The number of failed replications and failed filter ddocs
+def repl_dispatcher(dbs, running_repl_url, batch_id, monitor=None):
+	db_index = 0
+	num_failed_repl = num_failed_ddocs = 0
 	replications = []
 
 	repl_options = {
@@ -127,35 +357,41 @@ def repl_dispatcher(dbs, running_repl_url, batch_id):
 	}
 
 	while db_index < len(dbs):
+		# a replication may be POSTed once the running ones leave room for its weight
+		limit = config['concurrency_limit'] - db_weight(dbs[db_index][0]) + 1
+
 		try:
+			# with -B, fill every free slot (up to the batch size) with one _bulk_docs request
+			if config['submit_batch'] > 1:
+				if config['force_concurrency_limit']:
+					slots = fitting_dbs(dbs, db_index, free_slots(monitor, running_repl_url))
+				else:
+					slots = min(config['submit_batch'], len(dbs) - db_index)
+				if slots > 0:
+					failures = post_repl_batch(dbs[db_index:db_index + slots], db_index, len(dbs), repl_options, batch_id, monitor)
+					num_failed_repl += failures[0]
+					num_failed_ddocs += failures[1]
+					db_index += slots
+				else:
+					print 'Concurrent replication limit reached...waiting for replications to complete...'
+					wait_for_slot(monitor, limit)
+
 			# we only spawn new replications if it's below the limit.  Don't want
 			# to overload the cluster.
-			if not config['force_concurrency_limit'] or mm.poll_replicator(running_repl_url, config['mediator_auth'], config['concurrency_limit']):
-
-				source_db = target_db = dbs[db_index]
+			elif not config['force_concurrency_limit'] or below_limit(monitor, running_repl_url, limit):
 
-				# make the target db name unique if required
-				if config['rename_dbs']:
-					target_db += '-{0}'.format(db_date)
-
-				# attempt to create the target db with the new q value if desired
-				if not config['use_default_q']:
-					rm.create_new_db(config['target_url'], target_db, config['target_auth'], config['new_q'])
+				source_db, target_db = dbs[db_index]
 
 				# build a replication doc
-				repl_source = config['source_url'] + source_db
-				repl_target = config['target_url'] + target_db
-				doc = rm.create_repl_doc(repl_source, config['source_auth'], repl_target, 
-					config['target_auth'], config['mediator'], repl_options, batch_id, config['incremental_id'])
-
-				# create a design document for filtering ddocs if desired
-				if config['skip_ddocs']:
-					ddoc = fm.create_filter_func(config['source_url'] + source_db, config['source_auth'])
-					doc.update({'filter': '{0}/{1}'.format(ddoc['name'], ddoc['func'])})
+				doc = build_repl_doc(source_db, target_db, repl_options, batch_id)
+				repl_source = doc['source']['url']
 
 				# post the doc to the source db (i.e. the mediator)
 				rm.post_repl_doc(config['mediator_url'], doc, config['mediator_auth'])
 				replications.append(doc['_id'])
+				repl_weights[doc['_id']] = db_weight(source_db)
+				if monitor is not None:
+					monitor.posted(doc['_id'], db_weight(source_db))
 
 				# increment index in to array of dbs
 				db_index += 1
@@ -164,7 +400,7 @@ def repl_dispatcher(dbs, running_repl_url, batch_id):
 			else:
 				# sleep for an arbitrary amount of time before polling again
 				print 'Concurrent replication limit reached...waiting for replications to complete...'
-				time.sleep(config['polling_delay'])
+				wait_for_slot(monitor, limit)
 
 		# handle exceptions that may have happened
 		except ReplError as re:
@@ -186,15 +422,15 @@ def repl_dispatcher(dbs, running_repl_url, batch_id):
 	# wait for any remaining replications to finish if not continuous
 	if not config['continuous']:
 		print '\nWaiting for any remaining replications to complete.\n'
-		while not mm.poll_replicator(running_repl_url, config['mediator_auth'], 1):
-			time.sleep(config['polling_delay'])
+		while not below_limit(monitor, running_repl_url, 1):
+			wait_for_slot(monitor, 1)
 
 	# delete the filtering ddocs if they were created and if these replications are not continuous
 	if config['skip_ddocs'] and not config['continuous']:
 		print 'Deleting the ddocs used to filter the replications.\n'
 		db_index = 0
 		while db_index < len(dbs):
-			source_db = dbs[db_index]
+			source_db = dbs[db_index][0]
 			try:
 				fm.remove_filter_func(config['source_url'] + source_db, config['source_auth'])
 				db_index += 1
@@ -235,6 +471,8 @@ def printWelcome():
 		print 'Previous Batch ID: {0}'.format(config['incremental_id'])
 
 	print 'Number of Concurrent Replications: {0}'.format(config['concurrency_limit'])
+	print 'Follow _replicator Changes: {0}'.format(config['follow_changes'])
+	print 'Size-Weighted Scheduling: {0}'.format(config['size_weighted'])
 	print '=============================================\n'
 
 	selection = raw_input('Is this correct? (y/N):')
@@ -248,7 +486,7 @@ def printWelcome():
 # Returns:	Void
 def parse_ops(argv):
 	try:
-		opts, args = getopt.getopt(argv, 's:t:m:dl:fi:zc:p:q:ow:b:C:T:h')
+		opts, args = getopt.getopt(argv, 's:t:m:dl:fi:zc:p:q:ow:b:C:T:eP:B:Sh')
 	except getopt.GetoptError:
 		print usage
 		sys.exit(2)
@@ -286,6 +524,14 @@ def parse_ops(argv):
 			config['http_connections'] = int(arg)
 		elif opt == '-T':
 			config['connection_timeout'] = int(arg)
+		elif opt == '-e':
+			config['follow_changes'] = True
+		elif opt == '-P':
+			config['preflight_threads'] = int(arg)
+		elif opt == '-B':
+			config['submit_batch'] = int(arg)
+		elif opt == '-S':
+			config['size_weighted'] = True
 		elif opt == '-h':
 			print usage
 			sys.exit()
@@ -351,7 +597,21 @@ def main(argv):
 	dbs = config['db_list']
 	if len(dbs) == 0:
 		dbs = rm.get_dbs(config['source_url'], config['source_auth'])
-	print 'Retrieved {0} dbs.  Beginning the replication process...'.format(len(dbs))
+	print 'Retrieved {0} dbs.  Running pre-flight checks...'.format(len(dbs))
+
+	# check every account and prepare the target dbs before any replication is POSTed
+	ready, num_failed_dbs = preflight(dbs)
+	print '{0} of {1} dbs are ready.  Beginning the replication process...'.format(len(ready), len(dbs))
+
+	# size up the source dbs so the largest go first and take their share of the limit
+	if config['size_weighted']:
+		print 'Reading the size of {0} source dbs...'.format(len(ready))
+		ready, sizes = pm.plan_replications(config['source_url'], config['source_auth'], ready,
+			config['concurrency_limit'], config['preflight_threads'])
+		plan.update(sizes)
+		if len(ready) > 0:
+			print 'Largest db is {0} ({1} bytes, {2} slots of {3}).'.format(ready[0][0], plan[ready[0][0]]['size'],
+				plan[ready[0][0]]['weight'], config['concurrency_limit'])
 
 	# create the _replicator db on the source if it doesn't already exist
 	rm.create_replicator(config['mediator_url'], config['mediator_auth'])
@@ -359,10 +619,25 @@ def main(argv):
 	# deploy the ddocs on the _replicator db
 	running_repl_url = mm.create_repl_index(config['mediator_url'], config['mediator_auth'])
 
+	# track the replications from the _changes feed if requested
+	monitor = None
+	if config['follow_changes']:
+		monitor = mm.ReplicatorMonitor(config['mediator_url'], config['mediator_auth'])
+		monitor.start()
+
+	# look up where every incremental replication should start before any is POSTed
+	if config['incremental_id'] is not None:
+		print 'Reading the checkpoints of batch {0}...'.format(config['incremental_id'])
+		found = rm.resolve_sequence_nums(config['source_url'], config['source_auth'], [pair[0] for pair in ready],
+			config['incremental_id'], config['preflight_threads'])
+		print 'Found {0} of {1} sequence numbers.'.format(found, len(ready))
+		if found < len(ready):
+			print 'The other {0} dbs have no earlier replication to continue from and will fail.  View the log for the list.'.format(len(ready) - found)
+
 	# time to start posting replications
 	batch_id = int(time.time())
-	results = repl_dispatcher(dbs, running_repl_url, batch_id)
-	num_failed_repl = results[0]
+	results = repl_dispatcher(ready, running_repl_url, batch_id, monitor)
+	num_failed_repl = results[0] + num_failed_dbs
 	num_failed_ddocs = results[1]
 
 	# we're done replicating the list of databases
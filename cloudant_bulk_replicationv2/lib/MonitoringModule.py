@@ -1,11 +1,14 @@
 # Author:  Ryan Millay, SE - Cloudant
 # This file contains logic to deploy a ddoc to the _replicator db and to poll for the
-# number of replications currently running.
+# number of replications currently running, either from its view or by following
+# the _changes feed of the _replicator db.
 
 import json
 import requests
 import logging
 import time
+import sys
+import threading
 from ExceptionsModule import FatalError
 
 s = requests.Session()
@@ -47,16 +50,20 @@ def create_repl_index(url, auth):
 
 # Accepts:  1) The view URL to monitor on the mediator,
 #           2) The authorization for the mediator,
-#           3) The limit for concurrent replications,
-#           4) Number of retries remaining (defaults to 5)
-# Returns:  True if more replications can be POSTed, False otherwise
-def poll_replicator(url, auth, limit, retries=5):
+#           3) Number of retries remaining (defaults to 5),
+#           4) The weight of each replication doc, or None to count them
+# Returns:  The number (or total weight) of replications currently running
+def count_replications(url, auth, retries=5, weights=None):
 	# base case - we've run out of retries
 	if retries == 0:
 		print 'Retry limit (5) exceeded.  Failed to retrieve {0}.  Exiting...'.format(url)
 		raise FatalError('POLL_REPLICATOR: Failed to retreive {0}!  Retries exceeded!'.format(url), logging.CRITICAL)
 
-	r = s.get(url, headers={'Authorization': auth}).json()
+	# weighing needs the doc ids, so read the rows rather than the count
+	params = {}
+	if weights is not None:
+		params['reduce'] = 'false'
+	r = s.get(url, params=params, headers={'Authorization': auth}).json()
 
 	# handle potential errors
 	if 'error' in r:
@@ -64,15 +71,146 @@ def poll_replicator(url, auth, limit, retries=5):
 		retries -= 1
 		logging.warning('POLL_REPLICATOR: Failed to retrieve {0}.  {1} retries remaining.\n{2}'.format(url, retries, json.dumps(r, indent=4)))
 		time.sleep(5)
-		return poll_replicator(url, auth, limit, retries)
+		return count_replications(url, auth, retries, weights)
+
+	if weights is not None:
+		return sum(weights.get(row['id'], 1) for row in r.get('rows', []))
 
 	repl_running =  0
 	if 'rows' in r and len(r['rows']) == 1:
 		repl_running = r['rows'][0]['value']
+	return repl_running
+
+
+
+# Accepts:  1) The view URL to monitor on the mediator,
+#           2) The authorization for the mediator,
+#           3) The limit for concurrent replications,
+#           4) Number of retries remaining (defaults to 5),
+#           5) The weight of each replication doc, or None to count them
+# Returns:  True if more replications can be POSTed, False otherwise
+def poll_replicator(url, auth, limit, retries=5, weights=None):
+	repl_running = count_replications(url, auth, retries, weights)
 
 	if repl_running >= limit:
 		logging.info('POLL_REPLICATOR: Max concurrent replications reached ({0}).  Waiting.'.format(repl_running))
 		return False
 	else:
 		logging.info('POLL_REPLICATOR: There are {0} replications running.  Additional replications may be POSTed.'.format(repl_running))
-		return True
\ No newline at end of file
+		return True
+
+
+# Follows the _changes feed of the mediator's _replicator db and keeps the
+# _replication_state of every bulk replication doc in memory.  A doc counts
+# as running under the same rule as the num_running_repl view, so a waiting
+# dispatcher is woken the moment a replication leaves that state rather
+# than at its next poll.  If the feed can't be read or kept up, alive is False
+# and callers go back to polling the view.
+class ReplicatorMonitor(object):
+	def __init__(self, url, auth):
+		self.url = '{0}_replicator/_changes'.format(url)
+		self.auth = auth
+		self.states = {}
+		self.weights = {}
+		self.since = 0
+		self.alive = False
+		self.cond = threading.Condition()
+		self.session = requests.Session()
+
+
+	# Accepts:  Nothing
+	# Returns:  Void
+	def start(self):
+		# read the current state of every doc, then follow the feed from there
+		try:
+			r = self.session.get(self.url, params={'include_docs': 'true', 'since': self.since},
+					headers={'Authorization': self.auth})
+			if r.status_code != 200:
+				raise Exception('{0} returned {1}: {2}'.format(self.url, r.status_code, r.text))
+			results = r.json()
+		except:
+			# alive stays False, so callers poll the view from the start
+			print 'Unable to read {0}.  Polling the view instead...'.format(self.url)
+			logging.error('REPLICATOR_MONITOR: Unable to read {0}.  Polling the view instead.  Error: {1}'.format(self.url, sys.exc_info()))
+			return
+
+		for change in results['results']:
+			self.apply(change)
+		self.since = results['last_seq']
+		self.alive = True
+
+		t = threading.Thread(target=self.follow)
+		t.daemon = True
+		t.start()
+		logging.info('REPLICATOR_MONITOR: Following {0} with {1} replications running.'.format(self.url, self.running()))
+
+
+	# Accepts:  A row of the _changes feed
+	# Returns:  Void
+	def apply(self, change):
+		with self.cond:
+			self.since = change['seq']
+			if change['id'].startswith('cloudant_bulk_replication'):
+				if change.get('deleted'):
+					self.states.pop(change['id'], None)
+				else:
+					self.states[change['id']] = change['doc'].get('_replication_state')
+				self.cond.notify_all()
+
+
+	# Accepts:  Nothing
+	# Returns:  Void
+	def follow(self):
+		# each longpoll request returns as soon as there is a change after since
+		failures = 0
+		while failures < 5:
+			try:
+				r = self.session.get(self.url, params={'feed': 'longpoll', 'include_docs': 'true', 'timeout': 60000, 'since': self.since},
+						headers={'Authorization': self.auth}, timeout=90)
+				if r.status_code != 200:
+					raise Exception('{0} returned {1}'.format(self.url, r.status_code))
+				for change in r.json()['results']:
+					self.apply(change)
+				self.since = r.json()['last_seq']
+				failures = 0
+			except:
+				failures += 1
+				logging.warning('REPLICATOR_MONITOR: Lost {0}.  Reconnecting.  Error: {1}'.format(self.url, sys.exc_info()))
+				time.sleep(5)
+
+		print 'Unable to follow {0}.  Falling back to polling the view...'.format(self.url)
+		logging.error('REPLICATOR_MONITOR: Unable to follow {0}.  Falling back to polling the view.'.format(self.url))
+		with self.cond:
+			self.alive = False
+			self.cond.notify_all()
+
+
+	# Accepts:  1) The id of a replication doc that was just POSTed,
+	#           2) The number of slots it takes (defaults to 1)
+	# Returns:  Void
+	def posted(self, doc_id, weight=1):
+		# counted right away, so a slot isn't handed out twice before the feed sees the doc
+		with self.cond:
+			self.states.setdefault(doc_id, None)
+			self.weights[doc_id] = weight
+
+
+	# Accepts:  Nothing
+	# Returns:  The number of slots taken by the bulk replications currently running
+	def running(self):
+		with self.cond:
+			return sum(self.weights.get(doc_id, 1) for doc_id, state in self.states.items() if state is None or state == 'triggered')
+
+
+	# Accepts:  1) The limit for concurrent replications,
+	#           2) The longest time in seconds to wait
+	# Returns:  True if more replications can be POSTed, False otherwise
+	def wait_below(self, limit, timeout):
+		deadline = time.time() + timeout
+		with self.cond:
+			while self.alive and self.running() >= limit:
+				remaining = deadline - time.time()
+				if remaining <= 0:
+					break
+				self.cond.wait(remaining)
+			return self.alive and self.running() < limit
@@ -0,0 +1,87 @@
+# Author:  Ryan Millay, SE - Cloudant
+# This file contains logic to size up the source dbs before replicating them.  The largest dbs
+# are started first, take a share of the concurrency limit in line with their size, and get
+# replication options scaled to match.
+
+import requests
+import json
+import logging
+import sys
+from multiprocessing.dummy import Pool as ThreadPool
+
+s = requests.Session()
+
+# the most a db's workers and connections are multiplied by, however much data it holds
+MAX_SCALE = 4
+
+
+
+# Accepts:  A tuple of the base URL to the source account, the authorization header and a source db
+# Returns:  The size in bytes and doc count of the db, or zeros if it can't be read
+def get_db_size(job):
+	url, auth, db = job
+	try:
+		r = s.get('{0}{1}'.format(url, db), headers={'Authorization': auth}).json()
+	except:
+		logging.warning('GET_DB_SIZE: Failed to read {0}{1}.  Error: {2}'.format(url, db, sys.exc_info()))
+		return (0, 0)
+
+	if 'error' in r:
+		logging.warning('GET_DB_SIZE: Failed to read {0}{1}.  Planning it as an empty db.\n{2}'.format(url, db, json.dumps(r, indent=4)))
+		return (0, 0)
+
+	# the size of the data itself is what a replication moves, not the size of the files on disk
+	size = r.get('sizes', {}).get('external', r.get('other', {}).get('data_size', r.get('disk_size', 0)))
+	return (size or 0, r.get('doc_count', 0))
+
+
+
+# Accepts:  1) The base URL to the source account,
+#           2) The authorization header for the source,
+#           3) An array of (source db, target db) pairs,
+#           4) The limit for concurrent replications,
+#           5) The number of threads reading db sizes
+# Returns:  The pairs with the largest source db first, and a dict of the
+#           weight, size and doc count of every source db
+def plan_replications(url, auth, pairs, limit, threads):
+	pool = ThreadPool(threads)
+	sizes = pool.map(get_db_size, [(url, auth, pair[0]) for pair in pairs])
+	pool.close()
+	pool.join()
+
+	# A db takes as many slots of the limit as its share of all the data, rounded down.  At
+	# least one, so tiny dbs still count, and at most half, so a huge db never holds back the rest.
+	total = sum(size for size, doc_count in sizes)
+	most = max(1, limit // 2)
+	plan = {}
+	for pair, (size, doc_count) in zip(pairs, sizes):
+		weight = 1
+		if total > 0:
+			weight = min(most, max(1, size * limit // total))
+		plan[pair[0]] = {'weight': weight, 'size': size, 'doc_count': doc_count}
+
+	ordered = sorted(pairs, key=lambda pair: plan[pair[0]]['size'], reverse=True)
+	logging.info('PLAN_REPLICATIONS: {0} dbs holding {1} bytes.  Weights:\n{2}'.format(len(pairs), total,
+		json.dumps([[pair[0], plan[pair[0]]['weight']] for pair in ordered], indent=4)))
+	return ordered, plan
+
+
+
+# Accepts:  1) The replication options configured for every db,
+#           2) The plan of the db, as returned by plan_replications
+# Returns:  The replication options scaled for the db
+def tune_options(repl_options, entry):
+	options = dict(repl_options)
+
+	if entry['doc_count'] <= repl_options['worker_batch_size']:
+		# the whole db fits in a single batch, so one worker with a couple of connections will do
+		options['worker_processes'] = 1
+		options['http_connections'] = min(repl_options['http_connections'], 2)
+		options['worker_batch_size'] = max(entry['doc_count'], 1)
+	else:
+		# a db holding several slots of the limit gets the workers and connections of that many replications
+		scale = min(entry['weight'], MAX_SCALE)
+		options['worker_processes'] = repl_options['worker_processes'] * scale
+		options['http_connections'] = repl_options['http_connections'] * scale
+
+	return options
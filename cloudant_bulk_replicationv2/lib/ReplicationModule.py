@@ -5,6 +5,8 @@
 import requests
 import json
 import logging
+import sys
+from multiprocessing.dummy import Pool as ThreadPool
 from ExceptionsModule import ReplError
 from ExceptionsModule import FatalError
 from ExceptionsModule import FilterError
@@ -12,6 +14,9 @@ from ExceptionsModule import FilterError
 
 s = requests.Session()
 
+# sequence numbers found up front by resolve_sequence_nums, keyed by (source db, batch id)
+seq_cache = {}
+
 # Accepts:  1) A URL to a cloudant account, 
 #           2) the authorization header
 # Returns:  An array of all databases slated for replication from account1 to account2
@@ -64,9 +69,13 @@ def create_repl_doc(source, source_auth, target, target_auth, mediator, repl_opt
 			'batch_id': batch_id	
 	}
 
+	# every lookup was made by resolve_sequence_nums before the first doc was built.  A db
+	# without a sequence number, such as one created since the batch, fails on its own.
 	if incremental_id is not None:
-		seq_num = get_last_sequence_num(base_url, source_auth, db, incremental_id)
-		doc.update({'since_seq': seq_num})
+		if (db, incremental_id) not in seq_cache:
+			print 'Failed to find sequence number for incremental replication of {0}!'.format(db)
+			raise ReplError('CREATE_REPL_DOC: Failed to find sequence number for incremental replication of {0}!'.format(db), logging.ERROR)
+		doc.update({'since_seq': seq_cache[(db, incremental_id)]})
 
 	# add the replication paramaters
 	doc.update(repl_options)
@@ -92,6 +101,18 @@ def create_new_db(url, db, auth, q):
 
 
 
+# Accepts:  1) The URL for the Cloudant account,
+#           2) The authorization header for the account
+# Returns:  Void
+def check_auth(url, auth):
+	r = s.get('{0}_session'.format(url), headers={'Authorization': auth}).json()
+	if 'error' in r or r.get('userCtx', {}).get('name') is None:
+		print 'Failed to authenticate with {0}!\n{1}'.format(url, json.dumps(r, indent=4))
+		raise FatalError('CHECK_AUTH: Failed to authenticate with {0}!'.format(url), logging.CRITICAL)
+	logging.info('CHECK_AUTH: Authenticated with {0} as {1}.'.format(url, r['userCtx']['name']))
+
+
+
 # Accepts:  1) The mediator Cloudant account URL,
 #           2) The replication document to post,
 #           3) The authorization header for the mediator
@@ -110,6 +131,32 @@ def post_repl_doc(url, doc, auth):
 
 
 
+# Accepts:  1) The mediator Cloudant account URL,
+#           2) An array of replication documents to post,
+#           3) The authorization header for the mediator
+# Returns:  A ReplError for every doc that was not accepted
+def post_repl_docs(url, docs, auth):
+	# post all of the docs in one request
+	r = s.post(url + '_replicator/_bulk_docs', data=json.dumps({'docs': docs}),
+			headers={'content-type': 'application/json', 'Authorization': auth}).json()
+
+	# the request as a whole failed
+	if isinstance(r, dict) and 'error' in r:
+		print 'Failed to post {0} replication docs!\n{1}'.format(len(docs), json.dumps(r, indent=4))
+		raise ReplError('POST_REPL_DOCS: Failed to post {0} replication docs!'.format(len(docs)), logging.ERROR, r)
+
+	# otherwise every doc gets a row of its own
+	sources = dict((doc['_id'], doc['source']['url']) for doc in docs)
+	errors = []
+	for row in r:
+		if 'error' in row:
+			source = sources.get(row.get('id'))
+			print 'Failed to post a replication doc for {0}!\n{1}'.format(source, json.dumps(row, indent=4))
+			errors.append(ReplError('POST_REPL_DOCS: Failed to post a replication doc for {0}!'.format(source), logging.ERROR, row))
+	return errors
+
+
+
 # Accepts:  1) The URL for the Cloudant account
 #           2) The authorization header for the account
 # Returns:  Void
@@ -128,57 +175,109 @@ def create_replicator(url, auth):
 
 # Accepts:  1) The URL for the Cloudant account,
 #           2) The authorization header for the account,
-#           3) The source db that is slated to be replicated,
-#           4) The last batch id used for replications
-# Returns:  The last sequence number to include in the replication doc
-def get_last_sequence_num(url, auth, source_db, batch_id):
-	# first get the replication id
-	doc_url = '{0}_replicator/cloudant_bulk_replication_{1}_{2}'.format(url, source_db, batch_id)
-	r = s.get(doc_url, headers={'Authorization': auth}).json()
-
-	if 'error' in r or '_replication_id' not in r:
-		print 'Failed to find sequence number for incremental replication of {0}!'.format(source_db)
-		raise ReplError('GET_LAST_SEQUENCE_NUM: Failed to find sequence number for incremental replication of {0}!'.format(source_db), logging.ERROR, r)
-
-	repl_id = r['_replication_id']
-
-	# next get the sequence number
-	local_url = '{0}{1}/_local/{2}'.format(url, source_db, repl_id)
-	r = s.get(local_url, headers={'Authorization': auth}).json()
-
-	if 'error' in r and r['error'] == 'not_found':
-		print 'Previous seq number for {0} for batch {1} not available.  Trying next most recent batch ID...'.format(source_db, batch_id)
-		logging.warning('GET_LAST_SEQUENCE_NUM: No previous sequence number for {0} was found for batch ID {1}.'.format(source_db, batch_id))
-		logging.warning('GET_LAST_SEQUENCE_NUM: This is ok.  Previous replication for this db likely did not replicate any docs.')
-		return try_other_batch_ids(url, auth, source_db, batch_id)
-	elif 'error' in r:
-		print 'Failed to find sequence number for incremental replication of {0}!'.format(source_db)
-		raise ReplError('GET_LAST_SEQUENCE_NUM: Failed to find sequence number for incremental replication of {0}!'.format(source_db), logging.ERROR, r)
+#           3) The source dbs slated to be replicated,
+#           4) The last batch id used for replications,
+#           5) The number of threads reading checkpoints
+# Returns:  The number of sequence numbers found.  They are cached for create_repl_doc, so
+#           no lookups are left for the dispatcher.  A db whose checkpoint for the batch is
+#           missing gets the one of the most recent earlier batch that has one.
+def resolve_sequence_nums(url, auth, dbs, batch_id, threads):
+	# read every replication doc of the previous batch in one request
+	doc_ids = dict(('cloudant_bulk_replication_{0}_{1}'.format(db, batch_id), db) for db in dbs)
+	try:
+		r = s.post('{0}_replicator/_all_docs?include_docs=true'.format(url), data=json.dumps({'keys': sorted(doc_ids)}),
+				headers={'content-type': 'application/json', 'Authorization': auth}).json()
+	except:
+		r = {'error': str(sys.exc_info()[1])}
+
+	checkpoints = []
+	if 'error' in r or 'rows' not in r:
+		print 'Failed to read the replication docs of batch {0}.  Looking them up one db at a time...'.format(batch_id)
+		logging.warning('RESOLVE_SEQUENCE_NUMS: Failed to read the replication docs of batch {0}.\n{1}'.format(batch_id, json.dumps(r, indent=4)))
 	else:
-		seq_num = r['history'][0]['recorded_seq']
-		logging.info('GET_LAST_SEQUENCE_NUM: database: {0}, previous batch id: {1}, last sequence number: {2}'.format(source_db, batch_id, seq_num))
-		return seq_num
-
-
-
-# Accepts:  1) The URL for the Cloudant account,
-#           2) The authorization header for the account,
-#           3) The source db that is slated to be replicated,
-#           4) The previous batch ID which did not lead to a sequence number
-# Returns:  The last sequence number for the next most recent batch ID
-def try_other_batch_ids(url, auth, source_db, failed_batch_id):
-	# Query the _replicator for all docs that have the "cloudant_bulk_replication_<source_db>" base.
-	# Set the end key to the replication that resulted in a missing sequence number and disable inclusive_end.
-	# The results will be sorted based on batch ID (i.e. time) in ascending order.
-	startkey = 'cloudant_bulk_replication_{0}'.format(source_db)
-	endkey = '{0}_{1}'.format(startkey, failed_batch_id)
-	full_url = '{0}_replicator/_all_docs?startkey="{1}"&endkey="{2}"&inclusive_end=false&include_docs=true'.format(url, startkey, endkey)
-	r = s.get(full_url, headers={'Authorization': auth}).json()
-
-	if 'error' in r or 'rows' not in r or len(r['rows']) == 0:
-		print 'Unable to find a useable sequence number for {0}!'.format(source_db)
-		raise FatalError('TRY_OTHER_BATCH_IDS: Unable to find a useable sequence number for {0}!'.format(source_db), logging.ERROR, r)
-
-	num_results = len(r['rows'])
-	next_repl_batch = r['rows'][num_results - 1]['doc']['batch_id']
-	return get_last_sequence_num(url, auth, source_db, next_repl_batch)
+		for row in r['rows']:
+			doc = row.get('doc')
+			if doc is not None and '_replication_id' in doc:
+				checkpoints.append((url, auth, doc_ids[row['key']], doc['_replication_id']))
+
+	# then read their checkpoints concurrently
+	pool = ThreadPool(threads)
+	results = pool.map(get_checkpoint_seq, checkpoints)
+	for checkpoint, seq_num in zip(checkpoints, results):
+		if seq_num is not None:
+			seq_cache[(checkpoint[2], batch_id)] = seq_num
+
+	# and look through the earlier batches of the rest, the batch itself too if its docs couldn't be read
+	misses = [(url, auth, db, batch_id, len(checkpoints) == 0) for db in dbs if (db, batch_id) not in seq_cache]
+	results = pool.map(get_earlier_seq, misses)
+	pool.close()
+	pool.join()
+	for miss, seq_num in zip(misses, results):
+		if seq_num is not None:
+			seq_cache[(miss[2], batch_id)] = seq_num
+
+	found = sum(1 for db in dbs if (db, batch_id) in seq_cache)
+	logging.info('RESOLVE_SEQUENCE_NUMS: Found {0} of {1} sequence numbers for batch {2}.'.format(found, len(dbs), batch_id))
+	missing = [db for db in dbs if (db, batch_id) not in seq_cache]
+	if len(missing) > 0:
+		logging.warning('RESOLVE_SEQUENCE_NUMS: No sequence number in batch {0} or before it for these dbs, so they will fail:\n{1}'.format(
+			batch_id, json.dumps(missing, indent=4)))
+	return found
+
+
+
+# Accepts:  A tuple of the account URL, authorization header, source db, batch id, and whether
+#           to include the batch itself
+# Returns:  The sequence number of the most recent batch before it with a checkpoint, or None
+def get_earlier_seq(miss):
+	url, auth, source_db, batch_id, inclusive = miss
+	if not str(batch_id).isdigit():
+		logging.warning('GET_EARLIER_SEQ: {0} is not a batch id, so no earlier batch can be found for {1}.'.format(batch_id, source_db))
+		return None
+	# One query fetches every replication doc of the db, and their checkpoints are read
+	# newest batch first until one is found.
+	prefix = 'cloudant_bulk_replication_{0}_'.format(source_db)
+	params = {
+		'startkey': json.dumps(prefix),
+		'endkey': json.dumps(prefix + u'\ufff0'),
+		'include_docs': 'true'
+	}
+	try:
+		r = s.get('{0}_replicator/_all_docs'.format(url), params=params, headers={'Authorization': auth}).json()
+	except:
+		logging.warning('GET_EARLIER_SEQ: Failed to read the replication docs of {0}.  Error: {1}'.format(source_db, sys.exc_info()))
+		return None
+	if 'error' in r or 'rows' not in r:
+		logging.warning('GET_EARLIER_SEQ: Failed to read the replication docs of {0}.\n{1}'.format(source_db, json.dumps(r, indent=4)))
+		return None
+
+	# the range also takes in dbs whose names start with this one's and an underscore
+	batches = []
+	for row in r['rows']:
+		doc = row.get('doc') or {}
+		batch = row['id'][len(prefix):]
+		if batch.isdigit() and '_replication_id' in doc and (int(batch) < int(batch_id) or inclusive and int(batch) == int(batch_id)):
+			batches.append((int(batch), doc['_replication_id']))
+
+	for batch, repl_id in sorted(batches, reverse=True):
+		seq_num = get_checkpoint_seq((url, auth, source_db, repl_id))
+		if seq_num is not None:
+			logging.info('GET_EARLIER_SEQ: database: {0}, previous batch id: {1}, last sequence number: {2}'.format(source_db, batch, seq_num))
+			return seq_num
+	logging.warning('GET_EARLIER_SEQ: No batch before {0} has a sequence number for {1}.'.format(batch_id, source_db))
+	return None
+
+
+
+# Accepts:  A tuple of the account URL, authorization header, source db and replication id
+# Returns:  The sequence number recorded by the replication's checkpoint, or None
+def get_checkpoint_seq(checkpoint):
+	url, auth, source_db, repl_id = checkpoint
+	try:
+		r = s.get('{0}{1}/_local/{2}'.format(url, source_db, repl_id), headers={'Authorization': auth}).json()
+	except:
+		logging.warning('GET_CHECKPOINT_SEQ: Failed to read the checkpoint of {0}.  Error: {1}'.format(source_db, sys.exc_info()))
+		return None
+	if 'error' in r or len(r.get('history', [])) == 0:
+		return None
+	return r['history'][0]['recorded_seq']
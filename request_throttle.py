@@ -0,0 +1,173 @@
+import random
+import threading
+import time
+import email.utils
+import requests
+
+
+# jittered exponential backoff, in seconds
+BASE_BACKOFF = 1.0
+MAX_BACKOFF = 60.0
+# times a 429 or 503 is retried inside the session before it is handed back to the caller
+MAX_THROTTLE_RETRIES = 8
+
+
+class TokenBucket(object):
+    # Refills at rate units per second, holding at most one second's worth.
+    # Reservations may run the balance negative, and the caller then sleeps
+    # until the debt has been paid back.
+
+    def __init__(self, rate):
+        self.rate = float(rate)
+        self.tokens = self.rate
+        self.stamp = time.time()
+
+    def reserve(self, amount, now):
+        self.tokens = min(self.rate, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+        self.tokens -= amount
+        return max(0.0, -self.tokens / self.rate)
+
+
+class RateController(object):
+    # One per process.  Every request waits on the request and byte buckets,
+    # and a 429 or 503 seen by any thread pauses all of them together rather
+    # than each thread sleeping and retrying on its own.
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests = None
+        self.bytes = None
+        self.blocked_until = 0.0
+        self.failures = 0
+
+    def configure(self, requests_per_sec=0, bytes_per_sec=0):
+        with self.lock:
+            self.requests = TokenBucket(requests_per_sec) if requests_per_sec > 0 else None
+            self.bytes = TokenBucket(bytes_per_sec) if bytes_per_sec > 0 else None
+
+    def acquire(self, nbytes=0):
+        with self.lock:
+            now = time.time()
+            delay = max(0.0, self.blocked_until - now)
+            if self.requests is not None:
+                delay = max(delay, self.requests.reserve(1, now))
+            if self.bytes is not None:
+                delay = max(delay, self.bytes.reserve(nbytes, now))
+        if delay > 0:
+            time.sleep(delay)
+
+    def charge(self, nbytes):
+        # a body read in full by requests itself is only sized once it has
+        # arrived, so later requests pay for it
+        if self.bytes is not None and nbytes > 0:
+            with self.lock:
+                self.bytes.reserve(nbytes, time.time())
+
+    def consume(self, nbytes):
+        # a streamed body is paid for by the thread reading it, chunk by chunk
+        if self.bytes is None or nbytes <= 0:
+            return
+        with self.lock:
+            delay = self.bytes.reserve(nbytes, time.time())
+        if delay > 0:
+            time.sleep(delay)
+
+    def next_backoff(self):
+        # caller holds the lock
+        ceiling = min(MAX_BACKOFF, BASE_BACKOFF * 2 ** min(self.failures, 16))
+        self.failures += 1
+        return random.uniform(ceiling / 2, ceiling)
+
+    def throttled(self, retry_after=None):
+        with self.lock:
+            delay = self.next_backoff()
+            if retry_after is not None:
+                delay = max(delay, retry_after)
+            self.blocked_until = max(self.blocked_until, time.time() + delay)
+        return delay
+
+    def failed(self):
+        with self.lock:
+            delay = self.next_backoff()
+        time.sleep(delay)
+
+    def succeeded(self):
+        if self.failures > 0:
+            with self.lock:
+                self.failures = max(0, self.failures - 1)
+
+
+controller = RateController()
+
+
+def configure(requests_per_sec=0, bytes_per_sec=0):
+    controller.configure(requests_per_sec, bytes_per_sec)
+
+
+def backoff():
+    # used by the scripts' retry loops in place of a fixed sleep
+    controller.failed()
+
+
+def retry_after(r):
+    value = r.headers.get('Retry-After')
+    if value is None:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        date = email.utils.parsedate_tz(value)
+        if date is None:
+            return None
+        return max(0.0, email.utils.mktime_tz(date) - time.time())
+
+
+def body_size(data):
+    if isinstance(data, basestring):
+        return len(data)
+    if hasattr(data, 'read') and hasattr(data, '__len__'):
+        # a streamed body that knows its length up front
+        return len(data)
+    return 0
+
+
+def metered(iter_content):
+    # The _all_docs and _changes streams are chunked and carry no
+    # Content-Length, so their bytes are counted as they are read.  r.content,
+    # r.json() and r.iter_lines() all read through iter_content.
+    def read(*args, **kwargs):
+        for chunk in iter_content(*args, **kwargs):
+            controller.consume(len(chunk))
+            yield chunk
+    return read
+
+
+class Session(requests.Session):
+    # A requests.Session whose calls all go through the process wide
+    # controller.  429 and 503 responses are retried here after the shared
+    # backoff, and the number of retries is left on the response as
+    # r.throttled.
+
+    def request(self, method, url, **kwargs):
+        attempts = 0
+        while True:
+            if attempts > 0 and hasattr(kwargs.get('data'), 'seek'):
+                # a streamed body was used up by the throttled attempt
+                kwargs['data'].seek(0)
+            controller.acquire(body_size(kwargs.get('data')))
+            r = super(Session, self).request(method, url, **kwargs)
+            if kwargs.get('stream'):
+                r.iter_content = metered(r.iter_content)
+            else:
+                controller.charge(len(r.content or ''))
+            if r.status_code not in (429, 503) or attempts >= MAX_THROTTLE_RETRIES:
+                break
+            attempts += 1
+            delay = controller.throttled(retry_after(r))
+            print 'Throttled with a {0} from {1}.  Pausing all requests for {2:.1f}s.'.format(r.status_code, url, delay)
+            r.close()
+        if r.status_code not in (429, 503):
+            controller.succeeded()
+        r.throttled = attempts
+        return r
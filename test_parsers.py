@@ -0,0 +1,181 @@
+# -*- coding: utf-8 -*-
+# Offline checks of the hand written parsers in the backup and restore
+# scripts.  Run with "python -m unittest test_parsers".
+
+import collections
+import json
+import os
+import random
+import shutil
+import tempfile
+import unittest
+
+import all_docs_lookup
+import all_docs_restore
+import backup_common
+
+
+# ids that trip up anything scanning JSON text without tracking strings
+awkward_ids = [
+    u'plain',
+    u'has "quotes" inside',
+    u'braces { and } and [ ]',
+    u'back\\slash',
+    u'ends with a backslash \\',
+    u'\\"',
+    u'"}]},{"id":"fake"',
+    u'caf\xe9',
+    u'日本語',
+    u'emoji \U0001f600',
+    u'tab\tand\nnewline',
+]
+
+
+def make_docs():
+    docs = []
+    for i, doc_id in enumerate(awkward_ids):
+        docs.append({
+            '_id': doc_id,
+            '_rev': '{0}-{1:032x}'.format(i + 1, i),
+            'body': doc_id + u' {"nested": ["x", "}"]}',
+            'list': [{'a': '['}, {'b': '\\'}],
+        })
+    return docs
+
+
+def make_rows(docs):
+    # in the key order the server writes them
+    return [collections.OrderedDict([('id', doc['_id']), ('key', doc['_id']), ('value', {'rev': doc['_rev']}), ('doc', doc)])
+            for doc in docs]
+
+
+class RowSplitterTest(unittest.TestCase):
+
+    def split(self, body, sizes):
+        splitter = backup_common.RowSplitter()
+        rows = []
+        pos = 0
+        while pos < len(body):
+            size = sizes()
+            rows.extend(splitter.feed(body[pos:pos + size]))
+            pos += size
+        return [json.loads(row) for row in rows]
+
+    def test_all_docs_random_chunks(self):
+        rows = make_rows(make_docs())
+        body = json.dumps({'total_rows': len(rows), 'offset': 0, 'rows': rows})
+        rng = random.Random(1)
+        for trial in range(200):
+            self.assertEqual(self.split(body, lambda: rng.randint(1, 64)), rows)
+
+    def test_changes_random_chunks(self):
+        results = [{'seq': '{0}-abc'.format(i), 'id': doc['_id'], 'changes': [{'rev': doc['_rev']}], 'doc': doc}
+                   for i, doc in enumerate(make_docs())]
+        body = json.dumps({'results': results, 'last_seq': '99-abc', 'pending': 0}, indent=1)
+        rng = random.Random(2)
+        for trial in range(200):
+            self.assertEqual(self.split(body, lambda: rng.randint(1, 64)), results)
+
+    def test_single_bytes(self):
+        # every byte on its own, so each escape is cut from what follows it
+        rows = make_rows(make_docs())
+        body = json.dumps({'total_rows': len(rows), 'offset': 0, 'rows': rows})
+        self.assertEqual(self.split(body, lambda: 1), rows)
+
+
+class SplitLineTest(unittest.TestCase):
+
+    def setUp(self):
+        all_docs_restore.config['validate'] = False
+
+    def expected(self, text, ndjson):
+        row = json.loads(text)
+        doc = row if ndjson else row['doc']
+        return doc['_id'], doc.get('_rev'), doc
+
+    def check(self, text, ndjson, fast):
+        pattern = all_docs_restore.doc_prefix if ndjson else all_docs_restore.row_prefix
+        self.assertEqual(pattern.match(text) is not None, fast)
+        doc_id, rev, raw = all_docs_restore.split_line(text, ndjson)
+        self.assertEqual((doc_id, rev, json.loads(raw)), self.expected(text, ndjson))
+
+    def test_ndjson(self):
+        for doc in make_docs():
+            self.check(backup_common.format_doc(doc).rstrip(), True, True)
+
+    def test_ndjson_without_rev(self):
+        for doc in make_docs():
+            del doc['_rev']
+            self.check(backup_common.format_doc(doc).rstrip(), True, True)
+
+    def test_ndjson_other_key_order(self):
+        # _id not first, so only json.loads can find it
+        for doc in make_docs():
+            text = '{"body":' + json.dumps(doc['body']) + ',' + json.dumps(doc)[1:]
+            self.check(text, True, False)
+
+    def test_all_docs_rows(self):
+        for row in make_rows(make_docs()):
+            self.check(json.dumps(row, separators=(',', ':')), False, True)
+
+    def test_all_docs_rows_with_spaces(self):
+        for row in make_rows(make_docs()):
+            text = '{{"id": {0}, "key": {0}, "value": {{"rev": "{1}"}}, "doc": {2}}}'.format(
+                json.dumps(row['id']), row['value']['rev'], json.dumps(row['doc']))
+            self.check(text, False, True)
+
+    def test_all_docs_deleted_row(self):
+        text = '{"id":"gone","key":"gone","value":{"rev":"2-x","deleted":true},"doc":null}'
+        self.assertEqual(all_docs_restore.split_line(text, False), None)
+
+    def test_validate_falls_back(self):
+        # a doc whose _id differs from the row id is caught by --validate
+        all_docs_restore.config['validate'] = True
+        text = '{"id":"a","key":"a","value":{"rev":"1-x"},"doc":{"_id":"b","_rev":"1-x"}}'
+        self.assertEqual(all_docs_restore.split_line(text, False)[0], 'b')
+
+
+class BackupIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.docs = make_docs()
+        self.filename = os.path.join(self.dir, 'db.ndjson')
+        with open(self.filename, 'wb') as f:
+            for doc in self.docs:
+                f.write(backup_common.format_doc(doc))
+        self.assertEqual(all_docs_lookup.build_index(self.filename), len(self.docs))
+        self.index = all_docs_lookup.BackupIndex(self.filename)
+
+    def tearDown(self):
+        self.index.close()
+        shutil.rmtree(self.dir)
+
+    def test_get(self):
+        for doc in self.docs:
+            self.assertEqual(self.index.get(doc['_id']), doc)
+        self.assertEqual(self.index.get(u'caf'), None)
+        self.assertEqual(self.index.get(u'caf\xe9s'), None)
+
+    def test_sorted_as_utf8(self):
+        keys = [self.index.record(i)[0] for i in range(self.index.count)]
+        self.assertEqual(keys, sorted(doc['_id'].encode('utf-8') for doc in self.docs))
+
+    def test_ranges(self):
+        bounds = [None, u'caf', u'caf\xe9', u'emoji', u'日', u'￿']
+        for startkey in bounds:
+            for endkey in bounds:
+                found = [doc['_id'] for doc in self.index.iter_docs(startkey, endkey)]
+                expected = sorted((doc['_id'] for doc in self.docs
+                                   if all_docs_lookup.id_in_range(doc['_id'], startkey, endkey)),
+                                  key=all_docs_lookup.encode_key)
+                self.assertEqual(found, expected)
+
+    def test_prefix(self):
+        for prefix in [u'c', u'caf\xe9', u'日', u'emoji \U0001f600', u'\\']:
+            found = [doc['_id'] for doc in self.index.iter_docs(prefix=prefix)]
+            self.assertEqual(sorted(found), sorted(doc['_id'] for doc in self.docs if doc['_id'].startswith(prefix)))
+
+
+if __name__ == '__main__':
+    unittest.main()